@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# OctoPrint client benchmark: the REST calls of listen-for-octoprint.py sent
+# the way the script used to (a curl process per call) and the way it does now
+# (api_request() on a kept-alive connection, the script's own code), against
+# the fake OctoPrint with no added latency. Reports requests per second and
+# p50/p99 latency per command.
+# Usage: bench/api-bench.py [--calls 2000] [--json]
+from time import time
+import os
+import json
+import argparse
+import threading
+from fakeoctoprint import FakeOctoPrint
+
+var_daemon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'usr', 'local', 'bin', 'listen-for-octoprint.py')
+var_api_key = 'BENCHMARK0000'
+var_commands = (             # Command, method, path, curl body
+    ('pull state', 'GET', '/api/connection', None),
+    ('pull target', 'GET', '/api/printer/tool', None),
+    ('pull job', 'GET', '/api/job', None),
+    ('push temp', 'POST', '/api/printer/tool', '{ "command":"target", "targets": { "tool0":0.0 } }'),
+)
+
+# The script's definitions (everything before "# Begin Execution") on the sim
+# backend, with one printer bound to the fake OctoPrint
+def daemon_load(var_port):
+    os.environ['CONTROLPAD_GPIO'] = 'sim'
+    os.environ.pop('CONTROLPAD_SIM_RECORD', None)
+    with open(var_daemon_path) as stream:
+        var_source = stream.read().split('\n# Begin Execution\n')[0]
+    var_daemon = {'__name__': 'controlpad'}
+    exec(compile(var_source, var_daemon_path, 'exec'), var_daemon)
+    var_printer = var_daemon['printer_new']('bench')
+    var_printer.update(api_host='127.0.0.1', api_port=var_port, api_key=var_api_key)
+    var_daemon['printer_bind'](var_printer)
+    return var_daemon
+
+# One call as the script used to make it
+def call_curl(var_port, var_method, var_path, var_body):
+    var_command = 'curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X {} '.format(var_api_key, var_method)
+    if var_body is not None:
+        var_command = var_command + "-d '{}' ".format(var_body)
+    return os.popen(var_command + 'http://127.0.0.1:{}{}'.format(var_port, var_path)).read()
+
+def call_daemon(var_daemon, var_command):
+    if var_command == 'push temp':
+        return var_daemon['printer_push']('temp', 0.0)
+    return var_daemon['printer_pull'](var_command.split()[1])
+
+def bench_calls(var_call, var_calls):
+    var_latencies = []
+    var_start = time()
+    for _ in range(var_calls):
+        var_sent = time()
+        var_call()
+        var_latencies.append(time() - var_sent)
+    var_elapsed = time() - var_start
+    var_latencies.sort()
+    return {
+        'rps': round(var_calls / var_elapsed, 1),
+        'p50_ms': round(var_latencies[len(var_latencies) // 2] * 1000, 3),
+        'p99_ms': round(var_latencies[min(int(len(var_latencies) * 0.99), len(var_latencies) - 1)] * 1000, 3),
+    }
+
+def bench_run(var_calls):
+    var_fake = FakeOctoPrint(0.0, 0.0)
+    var_fake.var_state = 'Operational'
+    threading.Thread(target=var_fake.serve_forever).start()
+    var_port = var_fake.server_address[1]
+    var_report = {}
+    var_daemon = daemon_load(var_port)
+    try:
+        for var_command, var_method, var_path, var_body in var_commands:
+            var_report[var_command] = {
+                'curl': bench_calls(lambda: call_curl(var_port, var_method, var_path, var_body), var_calls),
+                'keep-alive': bench_calls(lambda: call_daemon(var_daemon, var_command), var_calls),
+            }
+    finally:
+        var_daemon['api_close']()
+        var_fake.shutdown()
+        var_fake.server_close()
+    return var_report
+
+def bench_print(var_report, var_calls):
+    print("{} calls per command and client".format(var_calls))
+    print("{:<12} {:>30} {:>30}".format('Command', 'curl', 'keep-alive'))
+    for var_command, _, _, _ in var_commands:
+        var_cells = ['{:>7.0f} req/s p50 {:.2f}ms p99 {:.2f}ms'.format(var_stats['rps'], var_stats['p50_ms'], var_stats['p99_ms']) for var_stats in (var_report[var_command]['curl'], var_report[var_command]['keep-alive'])]
+        print("{:<12} {:>30} {:>30}".format(var_command, *var_cells))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the old curl-per-call OctoPrint client with the keep-alive one')
+    parser.add_argument('--calls', type=int, default=2000, help='Calls per command and client')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    var_args = parser.parse_args()
+    var_report = bench_run(var_args.calls)
+    if var_args.json:
+        print(json.dumps(var_report, indent=2, sort_keys=True))
+    else:
+        bench_print(var_report, var_args.calls)
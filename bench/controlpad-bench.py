@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# Benchmark and soak test for listen-for-octoprint.py
+# Runs the real daemon (a copy with its user vars pointed at a scratch
+# directory) on the sim GPIO backend against a fake OctoPrint on localhost, and
+# reports CPU per hour and OctoPrint requests per minute in each printer state,
+# button-to-API latency and state-change-to-LED latency. The daemon follows the
+# fake's push stream as it does OctoPrint's (--poll to measure polling only),
+# and a recorded push log (octoprint-events.jsonl) is replayed at the end to
+# check it drives the print transitions. --soak keeps it busy for longer and
+# watches memory, file descriptors and threads for growth. --service checks
+# service mode instead: the watchdog catching workers stuck on a hung OctoPrint,
+# and a killed daemon resuming from its persisted state with the relays kept.
+#
+# Usage: bench/controlpad-bench.py [--phase 60] [--samples 20] [--latency 0.01]
+#                                  [--failures 0.0] [--poll] [--soak 3600] [--json]
+#        bench/controlpad-bench.py --service [--json]
+from time import sleep, time
+import os
+import re
+import sys
+import json
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from fakeoctoprint import FakeOctoPrint
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+var_daemon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'usr', 'local', 'bin', 'listen-for-octoprint.py')
+var_replay_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'octoprint-events.jsonl')
+var_replay_actions = ('started', 'paused', 'resumed', 'auto_shutdown') # Monitor actions the replayed print must cause, in order
+var_gpio_rly1 = 5
+var_gpio_led2 = 22
+var_gpio_btn0 = 25           # Printer Power
+var_gpio_btn1 = 4            # Home
+var_gpio_btn2 = 23           # Heat / Cool
+var_gpio_sen0 = 21
+var_panel = {                # Default layout, with the fake OctoPrint's address filled in
+    'api_host': '127.0.0.1',
+    'api_key': 'BENCHMARK0000',
+    'buttons': {
+        '25': {'short': 'power', 'long': 'fan'},
+        '4': {'short': 'home', 'long': 'calibrate'},
+        '23': {'short': 'heat', 'long': {'action': 'rgb', 'repeat': 0.55}},
+        '17': {'short': 'extrude', 'long': {'action': 'extrude_forced', 'repeat': 0.75}},
+        '27': {'short': 'pause'},
+    },
+}
+
+# Daemon Under Test
+# A copy of listen-for-octoprint.py with its user vars rewritten to the scratch
+# directory, the fake OctoPrint (through a JSON panel layout) and no socket, and
+# no metrics unless var_metrics_port is given. With var_service it runs in
+# service mode, persisting its state in the scratch directory and counting a
+# worker as stalled one second past its heartbeat. Inputs go to the sim
+# backend's stdin, and its output record is tailed for LED changes.
+class Daemon(object):
+    def __init__(self, var_dir, var_port, var_events, var_service=False, var_metrics_port=0):
+        with open(var_panel_path(var_dir), 'w') as stream:
+            json.dump(dict(var_panel, api_port=var_port), stream)
+        var_overrides = {
+            'var_conf_panel': var_panel_path(var_dir),
+            'var_conf_log_file': os.path.join(var_dir, 'controlpad.log'),
+            'var_conf_log_console': 0,
+            'var_conf_metrics_port': var_metrics_port,
+            'var_conf_socket': '',
+            'var_conf_state_file': var_state_path(var_dir) if var_service else '',
+            'var_conf_stats_file': os.path.join(var_dir, 'stats.db'),
+            'var_conf_events': var_events,
+        }
+        if var_service:
+            var_overrides.update({'var_conf_watchdog_stall': 1.0, 'var_conf_watchdog_interval': 0.5})
+        with open(var_daemon_path) as stream:
+            var_source = stream.read()
+        for var_name, var_value in var_overrides.items():
+            var_source = re.sub(r'^{} = .*$'.format(var_name), '{} = {!r}'.format(var_name, var_value), var_source, flags=re.M)
+        var_script = os.path.join(var_dir, 'listen-for-octoprint.py')
+        with open(var_script, 'w') as stream:
+            stream.write(var_source)
+        self.var_log_path = os.path.join(var_dir, 'controlpad.log')
+        self.var_record_path = os.path.join(var_dir, 'record.txt')
+        open(self.var_record_path, 'w').close()
+        self.var_record = open(self.var_record_path)
+        var_env = dict(os.environ, CONTROLPAD_GPIO='sim', CONTROLPAD_SIM_RECORD=self.var_record_path)
+        var_env.pop('CONTROLPAD_SIM_SCRIPT', None)
+        var_env.pop('CONTROLPAD_SERVICE', None)
+        var_env.pop('NOTIFY_SOCKET', None)
+        if var_service:
+            var_env['CONTROLPAD_SERVICE'] = '1'
+        self.var_metrics_port = var_metrics_port
+        self.var_devnull = open(os.devnull, 'w')
+        self.process = subprocess.Popen([sys.executable, '-u', var_script], stdin=subprocess.PIPE, stdout=self.var_devnull, stderr=subprocess.STDOUT, env=var_env)
+
+    def send(self, var_command):
+        self.process.stdin.write((var_command + '\n').encode('utf-8'))
+        self.process.stdin.flush()
+        return time()
+
+    # Press and release, returns when the release was sent
+    def click(self, var_gpio):
+        self.send('press {}'.format(var_gpio))
+        sleep(0.05)
+        return self.send('release {}'.format(var_gpio))
+
+    # Wait for the next write to var_gpio, returns when it was seen
+    def wait_output(self, var_gpio, var_timeout):
+        var_end = time() + var_timeout
+        while time() < var_end:
+            var_line = self.var_record.readline()
+            if not var_line:
+                sleep(0.001)
+                continue
+            var_words = var_line.split()
+            if (len(var_words) == 3) and (var_words[1] == str(var_gpio)) and var_words[2].isdigit():
+                return time()
+        return None
+
+    # Levels written to var_gpio so far
+    def levels(self, var_gpio):
+        with open(self.var_record_path) as stream:
+            return [int(var_words[2]) for var_words in (var_line.split() for var_line in stream) if (len(var_words) == 3) and (var_words[1] == str(var_gpio)) and var_words[2].isdigit()]
+
+    def skip_output(self):
+        self.var_record.seek(0, os.SEEK_END)
+
+    # Log records written since var_offset (a size of the log file)
+    def records(self, var_offset):
+        with open(self.var_log_path) as stream:
+            stream.seek(var_offset)
+            return [json.loads(var_line) for var_line in stream if var_line.strip()]
+
+    # Sum of a metric's series, 0 while the metrics server does not answer
+    def metric(self, var_name):
+        try:
+            var_text = urlopen('http://127.0.0.1:{}/metrics'.format(self.var_metrics_port), timeout=2).read().decode('utf-8')
+        except (IOError, OSError, socket.error):
+            return 0
+        return sum(float(var_line.split()[-1]) for var_line in var_text.splitlines() if var_line.startswith((var_name + '{', var_name + ' ')))
+
+    def cpu(self):
+        with open('/proc/{}/stat'.format(self.process.pid)) as stream:
+            var_fields = stream.read().rsplit(')', 1)[1].split()
+        return (int(var_fields[11]) + int(var_fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+    def resources(self):
+        var_status = {}
+        with open('/proc/{}/status'.format(self.process.pid)) as stream:
+            for var_line in stream:
+                var_key, _, var_value = var_line.partition(':')
+                var_status[var_key] = var_value.split()
+        return {
+            'rss_kb': int(var_status['VmRSS'][0]),
+            'fds': len(os.listdir('/proc/{}/fd'.format(self.process.pid))),
+            'threads': int(var_status['Threads'][0]),
+        }
+
+    # Killed without a chance to clean up, as systemd's watchdog does
+    def kill(self):
+        self.process.send_signal(signal.SIGKILL)
+        self.process.wait()
+        self.stop()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.var_record.close()
+        self.var_devnull.close()
+
+def var_panel_path(var_dir):
+    return os.path.join(var_dir, 'panel.json')
+
+def var_state_path(var_dir):
+    return os.path.join(var_dir, 'controlpad.state')
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    var_port = sock.getsockname()[1]
+    sock.close()
+    return var_port
+
+def wait_until(var_check, var_timeout):
+    var_end = time() + var_timeout
+    while time() < var_end:
+        if var_check():
+            return True
+        sleep(0.01)
+    return False
+
+def percentiles(var_samples):
+    var_sorted = sorted(var_samples)
+    if not var_sorted:
+        return None
+    def rank(var_fraction):
+        return var_sorted[min(int(var_fraction * len(var_sorted)), len(var_sorted) - 1)]
+    return {'n': len(var_sorted), 'p50': rank(0.5), 'p90': rank(0.9), 'p99': rank(0.99), 'max': var_sorted[-1]}
+
+# Benchmark Phases
+# Sit in a printer state for var_seconds, returns CPU seconds per hour and
+# OctoPrint requests per minute
+def bench_phase(var_daemon, var_fake, var_seconds):
+    var_cpu, var_start = var_daemon.cpu(), time()
+    sleep(var_seconds)
+    var_elapsed = time() - var_start
+    return {
+        'cpu_s_per_hour': round((var_daemon.cpu() - var_cpu) / var_elapsed * 3600, 2),
+        'api_per_minute': round(var_fake.count(var_start, time()) / var_elapsed * 60, 1),
+    }
+
+# Release of the home button to the home G-code reaching OctoPrint
+def bench_button(var_daemon, var_fake, var_samples):
+    var_latencies = []
+    for _ in range(var_samples):
+        var_sent = var_daemon.click(var_gpio_btn1)
+        if wait_until(lambda: var_fake.first(var_sent, 'POST', '/api/printer/command') is not None, 5.0):
+            var_latencies.append(var_fake.first(var_sent, 'POST', '/api/printer/command') - var_sent)
+        sleep(random.uniform(0.5, 1.5))
+    return var_latencies
+
+# OctoPrint pausing the print to LED 2 starting to blink
+def bench_led(var_daemon, var_fake, var_samples):
+    var_latencies = []
+    for _ in range(var_samples):
+        var_fake.var_state = 'Printing'
+        sleep(3.0)                                   # LED 2 settles off
+        var_daemon.skip_output()
+        var_changed = time()
+        var_fake.var_state = 'Paused'
+        var_seen = var_daemon.wait_output(var_gpio_led2, 10.0)
+        if var_seen is not None:
+            var_latencies.append(var_seen - var_changed)
+    var_fake.var_state = 'Printing'
+    return var_latencies
+
+# Soak: cycle through printing, pausing, heating and homing, sampling the
+# daemon's resources every var_sample seconds. Growth is judged on the second
+# half, after caches and pools have filled.
+def bench_soak(var_daemon, var_fake, var_seconds, var_sample):
+    var_samples = []
+    var_end = time() + var_seconds
+    var_next = time()
+    var_step = 0
+    while time() < var_end:
+        if time() >= var_next:
+            var_samples.append(dict(var_daemon.resources(), t=round(var_seconds - (var_end - time()), 1)))
+            var_next = var_next + var_sample
+        var_step = var_step + 1
+        if var_step % 4 == 0:
+            var_fake.var_state = random.choice(('Printing', 'Paused', 'Operational'))
+        elif var_step % 4 == 1:
+            var_daemon.click(var_gpio_btn2)
+        elif var_step % 4 == 2:
+            var_daemon.click(var_gpio_btn1)
+        else:
+            var_daemon.send('release {}'.format(var_gpio_sen0))
+            sleep(0.3)
+            var_daemon.send('press {}'.format(var_gpio_sen0))
+        sleep(2.0)
+    var_samples.append(dict(var_daemon.resources(), t=var_seconds))
+    var_half = var_samples[len(var_samples) // 2:]
+    var_report = {'samples': var_samples, 'growth': []}
+    if var_half[-1]['fds'] > var_half[0]['fds'] + 2:
+        var_report['growth'].append('fds')
+    if var_half[-1]['threads'] > var_half[0]['threads'] + 2:
+        var_report['growth'].append('threads')
+    if var_half[-1]['rss_kb'] > var_half[0]['rss_kb'] * 1.05:
+        var_report['growth'].append('rss')
+    return var_report
+
+# Replay the recorded push log from Operational and check the monitor went
+# through the print's transitions, and how much it polled meanwhile
+def bench_replay(var_daemon, var_fake, var_settle):
+    var_fake.var_state = 'Operational'
+    sleep(var_settle)
+    var_offset = os.path.getsize(var_daemon.var_log_path)
+    var_start = time()
+    var_fake.replay(var_replay_path)
+    wait_until(lambda: not var_fake.replaying(), 120.0)
+    sleep(2.0)                                   # Log worker flushes every second
+    var_elapsed = time() - var_start
+    var_seen = [var_record['action'] for var_record in var_daemon.records(var_offset) if (var_record.get('source') == 'Monitor') and ('action' in var_record)]
+    var_expected = list(var_replay_actions)
+    for var_action in var_seen:
+        if var_expected and (var_action == var_expected[0]):
+            var_expected.pop(0)
+    return {
+        'ok': not var_expected,
+        'missing': var_expected,
+        'actions': var_seen,
+        'streams': var_fake.var_streams,
+        'state_polls_per_minute': round(var_fake.count(var_start, time(), 'GET', '/api/printer') / var_elapsed * 60, 1),
+    }
+
+def bench_run(var_args):
+    var_report = {'latency': var_args.latency, 'failures': var_args.failures, 'events': not var_args.poll, 'phases': {}}
+    var_fake = FakeOctoPrint(var_args.latency, var_args.failures)
+    threading.Thread(target=var_fake.serve_forever).start()
+    var_dir = tempfile.mkdtemp(prefix='controlpad-bench-')
+    var_daemon = Daemon(var_dir, var_fake.server_address[1], 0 if var_args.poll else 1)
+    try:
+        if not wait_until(lambda: var_fake.count(0, time(), 'GET', '/api/connection') > 0, 30.0):
+            raise RuntimeError('the daemon never asked OctoPrint for its state, see {}'.format(os.path.join(var_dir, 'controlpad.log')))
+        sleep(2.0)                                   # Startup animation
+        var_daemon.send('press {}'.format(var_gpio_sen0))  # Filament loaded
+        var_report['phases']['powered-off'] = bench_phase(var_daemon, var_fake, var_args.phase)
+        var_daemon.click(var_gpio_btn0)
+        if not wait_until(lambda: var_fake.var_state == 'Operational', 30.0):
+            raise RuntimeError('the power button never connected the printer')
+        sleep(var_args.settle)
+        var_report['phases']['idle'] = bench_phase(var_daemon, var_fake, var_args.phase)
+        var_report['button_to_api'] = percentiles(bench_button(var_daemon, var_fake, var_args.samples))
+        var_fake.var_state = 'Printing'
+        sleep(var_args.settle)
+        var_report['phases']['printing'] = bench_phase(var_daemon, var_fake, var_args.phase)
+        var_report['state_to_led'] = percentiles(bench_led(var_daemon, var_fake, max(var_args.samples // 2, 1)))
+        if var_args.soak > 0:
+            var_report['soak'] = bench_soak(var_daemon, var_fake, var_args.soak, var_args.sample)
+        if not var_args.poll:
+            var_report['replay'] = bench_replay(var_daemon, var_fake, var_args.settle)
+        if var_daemon.process.poll() is not None:
+            raise RuntimeError('the daemon exited with {}, see {}'.format(var_daemon.process.returncode, os.path.join(var_dir, 'controlpad.log')))
+    finally:
+        var_daemon.stop()
+        var_fake.shutdown()
+    shutil.rmtree(var_dir)
+    return var_report
+
+# Service Check
+# Print with the printer on, hang the fake OctoPrint until the watchdog counts a
+# stalled worker, then kill the daemon and check that its restart resumes from
+# the persisted state without ever switching Relay 1 off
+def service_run(var_args):
+    var_report = {}
+    var_fake = FakeOctoPrint(var_args.latency, var_args.failures)
+    threading.Thread(target=var_fake.serve_forever).start()
+    var_dir = tempfile.mkdtemp(prefix='controlpad-bench-')
+    var_metrics_port = free_port()
+    var_daemon = Daemon(var_dir, var_fake.server_address[1], 0, True, var_metrics_port)
+    try:
+        if not wait_until(lambda: var_fake.count(0, time(), 'GET', '/api/connection') > 0, 30.0):
+            raise RuntimeError('the daemon never asked OctoPrint for its state, see {}'.format(os.path.join(var_dir, 'controlpad.log')))
+        sleep(2.0)                                   # Startup animation
+        var_daemon.send('press {}'.format(var_gpio_sen0))  # Filament loaded
+        var_daemon.click(var_gpio_btn0)
+        if not wait_until(lambda: var_fake.var_state == 'Operational', 30.0):
+            raise RuntimeError('the power button never connected the printer')
+        var_fake.var_state = 'Printing'
+        sleep(var_args.settle)
+        var_stalls = var_daemon.metric('controlpad_worker_stalls_total')
+        var_fake.var_hang.set()
+        var_start = time()
+        var_stalled = wait_until(lambda: var_daemon.metric('controlpad_worker_stalls_total') > var_stalls, 60.0)
+        var_report['stall_seconds'] = round(time() - var_start, 1) if var_stalled else None
+        var_report['stalls'] = var_daemon.metric('controlpad_worker_stalls_total') - var_stalls
+        var_fake.var_hang.clear()
+        var_daemon.kill()
+        with open(var_state_path(var_dir)) as stream:
+            var_report['persisted'] = json.load(stream)
+        var_offset = os.path.getsize(var_daemon.var_log_path)
+        var_daemon = Daemon(var_dir, var_fake.server_address[1], 0, True, var_metrics_port)
+        var_report['resumed'] = wait_until(lambda: any(var_record.get('action') == 'resume' for var_record in var_daemon.records(var_offset)), 30.0)
+        sleep(var_args.settle)
+        var_report['relay_kept'] = 1 not in var_daemon.levels(var_gpio_rly1)  # HIGH is off
+        if var_daemon.process.poll() is not None:
+            raise RuntimeError('the restarted daemon exited with {}, see {}'.format(var_daemon.process.returncode, os.path.join(var_dir, 'controlpad.log')))
+    finally:
+        var_fake.var_hang.clear()
+        var_daemon.stop()
+        var_fake.shutdown()
+    shutil.rmtree(var_dir)
+    var_report['ok'] = bool(var_report['stalls'] and var_report['resumed'] and var_report['relay_kept'])
+    return var_report
+
+def service_print(var_report):
+    if var_report['stall_seconds'] is None:
+        print("Watchdog       FAILED, no stall counted with OctoPrint hung")
+    else:
+        print("Watchdog       ok: {:.0f} stalled worker(s) counted {:.1f}s after OctoPrint hung".format(var_report['stalls'], var_report['stall_seconds']))
+    print("Persisted      {}".format(json.dumps(var_report['persisted'], sort_keys=True)))
+    print("Restart        {}, Relay 1 {}".format('resumed' if var_report['resumed'] else 'FAILED, no resume', 'kept on' if var_report['relay_kept'] else 'FAILED, switched off'))
+
+def bench_print(var_report):
+    print("OctoPrint latency {:.0f}ms, failure rate {:.0%}, {}".format(var_report['latency'] * 1000, var_report['failures'], 'push events' if var_report['events'] else 'polling only'))
+    print("{:<14} {:>14} {:>14}".format('State', 'CPU s/hour', 'API calls/min'))
+    for var_state in ('powered-off', 'idle', 'printing'):
+        var_phase = var_report['phases'][var_state]
+        print("{:<14} {:>14.2f} {:>14.1f}".format(var_state, var_phase['cpu_s_per_hour'], var_phase['api_per_minute']))
+    for var_key, var_title in (('button_to_api', 'Button to API'), ('state_to_led', 'State to LED')):
+        var_stats = var_report[var_key]
+        if var_stats is None:
+            print("{:<14} no samples".format(var_title))
+        else:
+            print("{:<14} n={} p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms max {:.1f}ms".format(var_title, var_stats['n'], var_stats['p50'] * 1000, var_stats['p90'] * 1000, var_stats['p99'] * 1000, var_stats['max'] * 1000))
+    if 'replay' in var_report:
+        var_replay = var_report['replay']
+        print("Event replay   {}: {} ({} stream(s), {:.1f} state polls/min)".format('ok' if var_replay['ok'] else 'FAILED, missing ' + ', '.join(var_replay['missing']), ' -> '.join(var_replay['actions']) or 'no transitions', var_replay['streams'], var_replay['state_polls_per_minute']))
+    if 'soak' in var_report:
+        var_first, var_last = var_report['soak']['samples'][0], var_report['soak']['samples'][-1]
+        print("Soak {:.0f}s: RSS {} -> {} kB, fds {} -> {}, threads {} -> {}, {}".format(var_last['t'], var_first['rss_kb'], var_last['rss_kb'], var_first['fds'], var_last['fds'], var_first['threads'], var_last['threads'], ('growing: ' + ', '.join(var_report['soak']['growth'])) if var_report['soak']['growth'] else 'no growth'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark listen-for-octoprint.py against a fake OctoPrint and simulated GPIO')
+    parser.add_argument('--phase', type=float, default=60.0, help='Seconds spent measuring each printer state')
+    parser.add_argument('--settle', type=float, default=6.0, help='Seconds to let polling settle after a state change')
+    parser.add_argument('--samples', type=int, default=20, help='Button presses timed (half as many state changes)')
+    parser.add_argument('--latency', type=float, default=0.01, help='Fake OctoPrint response delay (Seconds)')
+    parser.add_argument('--failures', type=float, default=0.0, help='Fraction of fake OctoPrint requests answered with HTTP 500')
+    parser.add_argument('--poll', action='store_true', help='Run the daemon without push events, polling only')
+    parser.add_argument('--soak', type=float, default=0.0, help='Seconds of soak test after the benchmark, 0 to skip')
+    parser.add_argument('--sample', type=float, default=60.0, help='Soak resource sampling interval (Seconds)')
+    parser.add_argument('--service', action='store_true', help='Check the service mode watchdog and restart instead of benchmarking')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    var_args = parser.parse_args()
+    if var_args.service:
+        var_report = service_run(var_args)
+        if var_args.json:
+            print(json.dumps(var_report, indent=2, sort_keys=True))
+        else:
+            service_print(var_report)
+        sys.exit(0 if var_report['ok'] else 1)
+    var_report = bench_run(var_args)
+    if var_args.json:
+        print(json.dumps(var_report, indent=2, sort_keys=True))
+    else:
+        bench_print(var_report)
+    if var_report.get('soak', {}).get('growth') or (not var_report.get('replay', {'ok': True})['ok']):
+        sys.exit(1)
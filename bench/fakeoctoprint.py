@@ -0,0 +1,216 @@
+# Fake OctoPrint shared by the benchmarks in this directory, serving on a free
+# port on localhost
+from time import sleep, time
+import json
+import sys
+import random
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
+
+# Fake OctoPrint
+# Answers the REST calls the daemon makes, from a small state machine. Every
+# request is delayed by var_latency and fails with HTTP 500 at var_failures
+# probability; both can be changed while it runs. While var_hang is set it
+# hangs like a wedged OctoPrint: requests get no answer and the push stream
+# goes quiet until it is cleared. Arrivals are kept as (time, method, path) for
+# the report.
+#
+# It also serves OctoPrint's push stream as SockJS xhr_streaming, after a
+# passive /api/login: a "current" message every second and an event whenever
+# var_state changes, as OctoPrint sends them. replay() plays a recorded push
+# log instead (JSON lines of {"t": seconds from the start, "message": ...}),
+# following its states in the REST answers too.
+var_state_events = {         # (state before, state after) -> push event type
+    ('Closed', 'Operational'): 'Connected',
+    ('Operational', 'Closed'): 'Disconnected',
+    ('Operational', 'Printing'): 'PrintStarted',
+    ('Printing', 'Paused'): 'PrintPaused',
+    ('Paused', 'Printing'): 'PrintResumed',
+    ('Printing', 'Operational'): 'PrintDone',
+    ('Paused', 'Operational'): 'PrintCancelled',
+}
+var_event_states = {         # Push event type -> state after it
+    'Connected': 'Operational',
+    'Disconnected': 'Closed',
+    'PrintStarted': 'Printing',
+    'PrintPaused': 'Paused',
+    'PrintResumed': 'Printing',
+    'PrintDone': 'Operational',
+    'PrintFailed': 'Operational',
+    'PrintCancelled': 'Operational',
+}
+
+class FakeOctoPrint(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, var_latency, var_failures):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeHandler)
+        self.var_latency = var_latency
+        self.var_failures = var_failures
+        self.var_state = 'Closed'
+        self.var_target = 0.0
+        self.var_actual = 21.0
+        self.var_requests = []
+        self.var_lock = threading.Lock()
+        self.var_streams = 0             # Push streams opened
+        self.var_replay = None           # Recorded messages still to send, see replay()
+        self.var_hang = threading.Event()
+        self.var_stopped = threading.Event()
+
+    def shutdown(self):
+        self.var_stopped.set()
+        HTTPServer.shutdown(self)
+
+    # Answers to requests the daemon gave up on (timeouts, hangs) go nowhere
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (IOError, OSError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def replay(self, var_path):
+        with open(var_path) as stream:
+            var_records = [json.loads(var_line) for var_line in stream if var_line.strip()]
+        self.var_replay = (time(), var_records)
+
+    def replaying(self):
+        return self.var_replay is not None
+
+    # Messages due on the push stream, var_sent is the state the stream last reported
+    def push_messages(self, var_sent, var_current):
+        var_messages = []
+        if self.var_replay is not None:
+            var_start, var_records = self.var_replay
+            while var_records and (var_records[0]['t'] <= time() - var_start):
+                var_message = var_records.pop(0)['message']
+                if 'event' in var_message:
+                    self.var_state = var_event_states.get(var_message['event'].get('type'), self.var_state)
+                elif 'current' in var_message:
+                    self.var_state = var_message['current']['state']['text']
+                    self.var_actual = var_message['current']['temps'][-1]['tool0']['actual']
+                    self.var_target = var_message['current']['temps'][-1]['tool0']['target']
+                var_messages.append(var_message)
+            if not var_records:
+                self.var_replay = None
+            return var_messages
+        var_state = self.var_state
+        if var_state != var_sent:
+            var_type = var_state_events.get((var_sent, var_state))
+            if var_type is not None:
+                var_messages.append({'event': {'type': var_type, 'payload': {}}})
+        if (var_state != var_sent) or var_current:
+            var_messages.append({'current': {'state': {'text': var_state}, 'temps': [{'time': int(time()), 'tool0': {'actual': self.var_actual, 'target': self.var_target}, 'bed': {'actual': 21.0, 'target': 0.0}}]}})
+        return var_messages
+
+    def count(self, var_start, var_end, var_method=None, var_path=None):
+        with self.var_lock:
+            return len([var_request for var_request in self.var_requests if (var_start <= var_request[0] < var_end) and (var_method in (None, var_request[1])) and (var_path in (None, var_request[2]))])
+
+    def first(self, var_start, var_method, var_path):
+        with self.var_lock:
+            for var_request in self.var_requests:
+                if (var_request[0] >= var_start) and (var_request[1] == var_method) and (var_request[2] == var_path):
+                    return var_request[0]
+        return None
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True   # Headers and body go out as separate writes, as with OctoPrint's server
+
+    def reply(self, var_status, var_body=None):
+        var_data = b'' if var_body is None else json.dumps(var_body).encode('utf-8')
+        self.send_response(var_status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(var_data)))
+        self.end_headers()
+        self.wfile.write(var_data)
+
+    def arrive(self, var_method):
+        var_path = self.path.split('?')[0]
+        with self.server.var_lock:
+            self.server.var_requests.append((time(), var_method, var_path))
+        while self.server.var_hang.is_set() and (not self.server.var_stopped.wait(0.05)):
+            pass
+        sleep(self.server.var_latency)
+        return var_path, random.random() < self.server.var_failures
+
+    def do_GET(self):
+        var_path, var_fail = self.arrive('GET')
+        var_server = self.server
+        if var_fail:
+            self.reply(500, {})
+        elif var_path == '/api/connection':
+            self.reply(200, {'current': {'state': var_server.var_state}})
+        elif var_path == '/api/printer':
+            if var_server.var_state == 'Closed':
+                self.reply(409, {})
+            else:
+                self.reply(200, {'state': {'text': var_server.var_state}, 'temperature': {'tool0': {'actual': var_server.var_actual, 'target': var_server.var_target}, 'bed': {'actual': 21.0, 'target': 0.0}}})
+        elif var_path == '/api/printer/tool':
+            self.reply(200, {'tool0': {'actual': var_server.var_actual, 'target': var_server.var_target}})
+        elif var_path == '/api/job':
+            self.reply(200, {'state': var_server.var_state})
+        else:
+            self.reply(404, {})
+
+    def do_POST(self):
+        var_body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        var_path, var_fail = self.arrive('POST')
+        var_server = self.server
+        if var_fail:
+            self.reply(500, {})
+            return
+        try:
+            var_request = json.loads(var_body.decode('utf-8') or '{}')
+        except ValueError:
+            var_request = {}
+        var_command = var_request.get('command') if isinstance(var_request, dict) else None
+        if var_path == '/api/connection':
+            var_server.var_state = 'Operational' if var_command == 'connect' else 'Closed'
+        elif (var_path == '/api/job') and (var_command == 'pause'):
+            var_server.var_state = 'Paused' if var_request.get('action') == 'pause' else 'Printing'
+        elif (var_path == '/api/job') and (var_command == 'cancel'):
+            var_server.var_state = 'Operational'
+        elif (var_path == '/api/printer/tool') and (var_command == 'target'):
+            var_server.var_target = float(var_request['targets']['tool0'])
+            var_server.var_actual = var_server.var_target or 21.0
+        elif var_path == '/api/login':
+            self.reply(200, {'name': '_api', 'session': 'bench'})
+            return
+        elif var_path.endswith('/xhr_streaming'):
+            self.stream()
+            return
+        self.reply(204)
+
+    # SockJS xhr_streaming: prelude, open frame, then message arrays, one per
+    # line, until the daemon hangs up or the server stops
+    def stream(self):
+        var_server = self.server
+        var_server.var_streams = var_server.var_streams + 1
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/javascript; charset=UTF-8')
+        self.end_headers()
+        var_sent = None
+        var_current = 0.0
+        try:
+            self.wfile.write(b'h' * 2048 + b'\no\n')
+            while not var_server.var_stopped.wait(0.02):
+                if var_server.var_hang.is_set():
+                    continue
+                var_messages = var_server.push_messages(var_sent, time() - var_current >= 1.0)
+                if var_messages:
+                    self.wfile.write(('a' + json.dumps([json.dumps(var_message) for var_message in var_messages]) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+                    var_current = time()
+                var_sent = var_server.var_state
+        except (IOError, OSError):
+            pass
+
+    def log_message(self, *var_args):
+        pass
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Usage statistics recorded by listen-for-octoprint.py (var_conf_stats_file):
+# printer and fan relay hours, prints started, paused and ended, print outcomes
+# and button use, per printer, over all time or the last --days.
+# Usage: controlpad-stats.py [--db /var/lib/controlpad/stats.db] [--days 30] [--printer printer1] [--json]
+from time import time, strftime, localtime
+import os
+import sys
+import json
+import socket
+import sqlite3
+import argparse
+
+var_conf_stats_file = '/var/lib/controlpad/stats.db' # Same as in listen-for-octoprint.py
+
+# Sum the rows by printer, kind and name, the database is only read
+def stats_query(var_path, var_since, var_printer):
+    if not os.path.exists(var_path):
+        raise IOError("no statistics at {}".format(var_path))
+    try:
+        db = sqlite3.connect('file:{}?mode=ro'.format(var_path), uri=True)
+    except TypeError:
+        db = sqlite3.connect(var_path)                 # Python 2 has no URI filenames
+    var_sql = 'SELECT printer, kind, name, SUM(value), MIN(time), MAX(time) FROM usage WHERE time >= ?'
+    var_args = [var_since]
+    if var_printer is not None:
+        var_sql = var_sql + ' AND printer = ?'
+        var_args.append(var_printer)
+    var_printers = {}
+    for var_name, var_kind, var_key, var_sum, var_first, var_last in db.execute(var_sql + ' GROUP BY printer, kind, name', var_args):
+        var_stats = var_printers.setdefault(var_name, {'first': var_first, 'last': var_last, 'power': {}, 'print': {}, 'job': {}, 'button': {}, 'socket': {}})
+        var_stats['first'] = min(var_stats['first'], var_first)
+        var_stats['last'] = max(var_stats['last'], var_last)
+        var_stats.setdefault(var_kind, {})[var_key] = var_sum
+    db.close()
+    for var_stats in var_printers.values():
+        var_stats['printer_hours'] = round(var_stats['power'].get('printer', 0) / 3600.0, 2)
+        var_stats['fan_hours'] = round(var_stats['power'].get('fan', 0) / 3600.0, 2)
+        var_started = int(var_stats['print'].get('started', 0))
+        var_outcomes = sum(var_stats['job'].values())
+        var_stats['pause_rate'] = round(var_stats['print'].get('paused', 0) / float(var_started), 3) if var_started else None
+        var_stats['cancel_rate'] = round(var_stats['job'].get('cancelled', 0) / float(var_outcomes), 3) if var_outcomes else None
+    return var_printers
+
+def stats_rate(var_rate):
+    return 'n/a' if var_rate is None else '{:.0%}'.format(var_rate)
+
+def stats_print(var_printers):
+    print("Usage statistics of {}".format(socket.gethostname()))
+    if not var_printers:
+        print("No usage recorded in this period")
+    for var_name in sorted(var_printers):
+        var_stats = var_printers[var_name]
+        var_print = var_stats['print']
+        print("")
+        print("{} ({} to {})".format(var_name, strftime('%Y-%m-%d %H:%M', localtime(var_stats['first'])), strftime('%Y-%m-%d %H:%M', localtime(var_stats['last']))))
+        print("  Printer on   {:.1f} h".format(var_stats['printer_hours']))
+        print("  Fan on       {:.1f} h".format(var_stats['fan_hours']))
+        print("  Prints       {:.0f} started, {:.0f} ended, {:.0f} paused, {:.0f} resumed, pause rate {}".format(var_print.get('started', 0), var_print.get('ended', 0), var_print.get('paused', 0), var_print.get('resumed', 0), stats_rate(var_stats['pause_rate'])))
+        if var_stats['job']:
+            print("  Outcomes     {:.0f} done, {:.0f} cancelled, {:.0f} failed, cancel rate {}".format(var_stats['job'].get('done', 0), var_stats['job'].get('cancelled', 0), var_stats['job'].get('failed', 0), stats_rate(var_stats['cancel_rate'])))
+        else:
+            print("  Outcomes     not recorded (needs OctoPrint push events)")
+        for var_kind, var_title in (('button', 'Buttons'), ('socket', 'Socket')):
+            if var_stats[var_kind]:
+                print("  {:<12} {}".format(var_title, ', '.join('{} {:.0f}'.format(var_key, var_value) for var_key, var_value in sorted(var_stats[var_kind].items(), key=lambda var_item: -var_item[1]))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the usage statistics recorded by listen-for-octoprint.py')
+    parser.add_argument('--db', default=var_conf_stats_file, help='Statistics database')
+    parser.add_argument('--days', type=float, default=0, help='Only the last DAYS days, 0 for all time')
+    parser.add_argument('--printer', help='Only this printer')
+    parser.add_argument('--json', action='store_true', help='Print the aggregates as JSON')
+    var_args = parser.parse_args()
+    try:
+        var_printers = stats_query(var_args.db, time() - (var_args.days * 86400) if var_args.days > 0 else 0, var_args.printer)
+    except (IOError, sqlite3.Error) as e:
+        sys.stderr.write("Error: Can't read usage statistics ({})\n".format(e))
+        sys.exit(1)
+    if var_args.json:
+        print(json.dumps(var_printers, indent=2, sort_keys=True))
+    else:
+        stats_print(var_printers)
@@ -1,18 +1,98 @@
 #!/usr/bin/env python
 
-import RPi.GPIO as GPIO
+from time import sleep, time
+var_started = time()         # Startup timing report starts here
 import subprocess
 import os
 import json
-import yaml
-from multiprocessing import Process
-from time import sleep
+import socket
+import threading
+import random
+import traceback
+import signal
+import sqlite3
+from collections import deque
+from array import array
 import sys
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = time         # Python 2 has no monotonic clock, wall time will do
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+try:
+    from SocketServer import ThreadingUnixStreamServer, StreamRequestHandler
+except ImportError:
+    from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
 
 # User Vars
 var_conf_warmup_target = 200 # Target temperature when warming-up the hotend (Degrees C)
 var_conf_shutdown_auto = 1   # Enable (1) or Disable (0) automatic printer shutdown
 var_conf_shutdown_time = 12  # Automatic printer shutdown delay time (Seconds)
+var_conf_shutdown_temp = 50.0 # Automatic shutdown keeps the relays on until the hotend is below this (Degrees C)
+var_conf_shutdown_cooldown = 1800 # Longest automatic shutdown waits for the hotend to cool (Seconds)
+var_conf_api_config = '/home/pi/.octoprint/config.yaml' # OctoPrint config holding the API key
+var_conf_api_ready = 120     # Report OctoPrint as not answering after this long, keeps retrying (Seconds)
+var_conf_api_host = '127.0.0.1' # OctoPrint host
+var_conf_api_port = 80       # OctoPrint port
+var_conf_api_timeout = 2.0   # OctoPrint API request timeout (Seconds)
+var_conf_api_retries = 3     # OctoPrint API attempts per pull before giving up
+var_conf_api_retry_delay = 0.25 # Delay between failed pull attempts (Seconds)
+var_conf_connect_port_wait = 10.0 # Longest a connect attempt waits for OctoPrint to list a serial port before connecting anyway (Seconds)
+var_conf_connect_timeout = 10.0 # Longest one connect attempt waits for the printer to become operational once the connect request is sent (Seconds)
+var_conf_connect_attempts = 2 # Connect attempts before giving up, see printer_connect()
+var_conf_connect_poll = 0.1  # First connection poll interval, doubles up to 1 second while waiting (Seconds)
+var_conf_connect_preheat = 0 # Heat the hotend to the warmup target while homing after connecting (1) or not (0)
+var_conf_events = 1          # Follow printer state from OctoPrint push events (1) or poll only (0)
+var_conf_events_timeout = 35 # Push stream silence before falling back to polling (Seconds)
+var_conf_debounce = 0.02     # Button must hold a level this long before it counts (Seconds)
+var_conf_longpress = 0.75    # Button hold time before the long-press action fires (Seconds)
+var_conf_sound_queue = 4     # Sounds allowed to wait for the speaker before new ones are dropped
+var_conf_power_button = 1    # Halt the Pi from Button 5 (1) or leave its GPIO alone (0)
+var_conf_halt_cooldown = 300 # Longest Button 5 keeps the relays on for hotends to cool below shutdown_temp before halting, 0 not to wait (Seconds)
+var_conf_runout_pause = 1    # Pause the print when the filament runs out (1) or only signal it (0)
+var_conf_runout_debounce = 0.1 # Filament sensor must read a level this long before it counts (Seconds)
+var_conf_runout_window = 5   # Filament sensor samples taken per debounce time, the majority wins
+var_conf_runout_recheck = 1.0 # Filament sensor read without an edge to catch missed ones (Seconds)
+var_conf_extrude_temp = 180.0 # Lowest hotend temperature the extrude button extrudes at (Degrees C)
+var_conf_temp_samples = 120  # Temperature readings kept per tool and bed
+var_conf_temp_trend = 10     # Latest readings the heating rate is fitted over
+var_conf_temp_band = 3.0     # Within this of its target a heater counts as ready (Degrees C)
+var_conf_temp_age = 5.0      # Max age of the latest temperature reading before actions ask OctoPrint (Seconds)
+var_conf_cache_age = 1.0     # Max age of the monitor's printer state before buttons ask OctoPrint (Seconds)
+var_conf_poll_fast = 0.25    # Monitor poll interval after a state change or button press (Seconds)
+var_conf_poll_busy = 1.0     # Monitor poll interval while printing or paused (Seconds)
+var_conf_poll_idle = 3.0     # Monitor poll interval while idle or powered-off (Seconds)
+var_conf_poll_boost = 5.0    # How long a state change or button press keeps polling fast (Seconds)
+var_conf_poll_backoff = 10.0 # Longest retry interval while OctoPrint is unreachable (Seconds)
+var_conf_metrics_host = '127.0.0.1' # Metrics endpoint address, '0.0.0.0' to scrape from other hosts
+var_conf_metrics_port = 9101 # Metrics endpoint port, 0 to disable
+var_conf_socket = '/run/controlpad.sock' # Local control socket, '' to disable
+var_conf_socket_mode = 0o660 # Control socket permissions, owner and group may use it
+var_conf_socket_timeout = 30.0 # Longest a control socket action is waited for (Seconds)
+var_conf_panel = '/etc/controlpad.yaml' # Button layout, built-in layout when the file is missing
+var_conf_log_file = '/var/log/controlpad.log' # Event log (JSON lines), '' to disable
+var_conf_log_size = 1048576  # Rotate the event log past this size (Bytes)
+var_conf_log_keep = 3        # Rotated event logs to keep (controlpad.log.1 ... .3)
+var_conf_log_buffer = 2000   # Log records held in memory before the oldest are dropped
+var_conf_log_console = 1     # Also echo log records to stdout (1) or not (0)
+var_conf_stats_file = '/var/lib/controlpad/stats.db' # Usage statistics (SQLite), '' to disable, read with controlpad-stats.py
+var_conf_stats_flush = 60.0  # Usage statistics are summed in memory and written this often (Seconds)
+var_conf_service = int(os.environ.get('CONTROLPAD_SERVICE', '0')) # 1 when run by the systemd unit: keep printer power across restarts
+var_conf_state_file = '/run/controlpad.state' # Relay and print state restored after a restart in service mode
+var_conf_watchdog_interval = 5.0 # Worker check interval, shortened to half of systemd's WatchdogSec (Seconds)
+var_conf_watchdog_stall = 60.0 # A worker this far past its next expected heartbeat counts as stalled (Seconds)
+var_conf_gpio_backend = os.environ.get('CONTROLPAD_GPIO', 'rpi') # GPIO backend: rpi, gpiod, or sim to run off a Pi
 
 # Assign GPIOs
 var_gpio_rly1 = 5            # Relay 1   Printer Power
@@ -26,518 +106,2728 @@ var_gpio_btn1 = 4            # Button 1  Home / Cancel / Reconnect
 var_gpio_btn2 = 23           # Button 2  Heat / Cool
 var_gpio_btn3 = 17           # Button 3  Extrude
 var_gpio_btn4 = 27           # Button 4  Pause / Resume
+var_gpio_btn5 = 3            # Button 5  Pi Power (Shutdown)
 var_gpio_sen0 = 21           # Sensor 0  Filament Sensor
 
+# Tasks
+# The controller runs in this one process as a set of task threads: input
+# (loop, on the main thread), button actions, monitor, push events, LEDs and
+# sound. A task that raises is reported and restarted. destroy() sets var_stop
+# and each task loop exits at its next wake-up.
+var_stop = threading.Event()
+
+# Start a background thread, the daemon exits without waiting for it
+def thread_start(var_target, *var_args):
+    t = threading.Thread(target=var_target, args=var_args)
+    t.daemon = True
+    t.start()
+    return t
+
+def task(var_name, var_target, *var_args):
+    var_watchdog_local.name = var_name
+    try:
+        while not var_stop.is_set():
+            try:
+                var_target(*var_args)
+                return
+            except Exception:
+                log('Task', "Error: {} crashed, restarting".format(var_name), task=var_name, trace=traceback.format_exc())
+                metric_inc('controlpad_task_restarts_total', (('task', var_name),))
+                var_stop.wait(1.0)
+    finally:
+        var_watchdog.pop(var_name, None)
+
+# Watchdog
+# Every task reports progress with watchdog_beat(var_wait), var_wait being the
+# longest it expects to take until its next beat, or None while it sits idle
+# waiting for work (an empty queue is not a stall). watchdog_loop() checks each
+# worker against its deadline plus var_conf_watchdog_stall, logs stalls with
+# their timings, and pings the systemd watchdog only while no worker has
+# stalled, so systemd restarts a hung daemon (see etc/systemd/system).
+var_watchdog = {}            # Worker -> (last beat, deadline or None while idle), monotonic
+var_watchdog_local = threading.local()
+var_watchdog_stalled = set()
+
+def watchdog_beat(var_wait=0.0):
+    var_name = getattr(var_watchdog_local, 'name', None)
+    if var_name is None:
+        return
+    var_now = monotonic()
+    var_watchdog[var_name] = (var_now, None if var_wait is None else var_now + var_wait + var_conf_watchdog_stall)
+
+def watchdog_loop():
+    var_interval = var_conf_watchdog_interval
+    if os.environ.get('WATCHDOG_USEC'):
+        var_interval = min(var_interval, int(os.environ['WATCHDOG_USEC']) / 2000000.0)
+    while not var_stop.wait(var_interval):
+        var_now = monotonic()
+        var_stalled = set()
+        for var_name, (var_beat, var_deadline) in list(var_watchdog.items()):
+            metric_set('controlpad_worker_heartbeat_age_seconds', (('worker', var_name),), var_now - var_beat)
+            if (var_deadline is not None) and (var_now > var_deadline):
+                var_stalled.add(var_name)
+                if var_name not in var_watchdog_stalled:
+                    log('Watchdog', "Error: {} stalled, no heartbeat for {:.1f}s (allowed {:.1f}s)".format(var_name, var_now - var_beat, var_deadline - var_beat), worker=var_name, latency=round(var_now - var_beat, 3))
+                    metric_inc('controlpad_worker_stalls_total', (('worker', var_name),))
+            elif var_name in var_watchdog_stalled:
+                log('Watchdog', "{} recovered".format(var_name), worker=var_name)
+        var_watchdog_stalled.clear()
+        var_watchdog_stalled.update(var_stalled)
+        if not var_stalled:
+            sd_notify('WATCHDOG=1')
+
+# Tell systemd (Type=notify) about readiness, watchdog pings and stopping
+def sd_notify(var_message):
+    var_address = os.environ.get('NOTIFY_SOCKET')
+    if not var_address:
+        return
+    if var_address.startswith('@'):
+        var_address = '\0' + var_address[1:]  # Abstract namespace
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(var_address)
+        sock.sendall(var_message.encode('utf-8'))
+    except socket.error as e:
+        log('Watchdog', "Error: Can't notify systemd ({})".format(e))
+    finally:
+        sock.close()
+
+# Printers
+# Everything that belongs to one printer lives in a context dict: its name,
+# OctoPrint address and API key, GPIOs, warmup and shutdown policy, and the
+# runtime state of its monitor, push events, button queue and shared state
+# cache. Each per-printer task thread binds its context with printer_bind()
+# and the code below reads it back with printer_ctx(). The GPIO backend, LED
+# and sound workers, input task, HTTP connections, metrics and log are shared.
+# The printers come from the panel layout, see panel_load().
+var_printers = []
+var_printer_local = threading.local()
+
+def printer_new(var_name):
+    return {
+        'name': var_name,
+        'api_host': var_conf_api_host,
+        'api_port': var_conf_api_port,
+        'api_config': var_conf_api_config,
+        'api_key': None,
+        'warmup_target': var_conf_warmup_target,
+        'connect_preheat': var_conf_connect_preheat,
+        'shutdown_auto': var_conf_shutdown_auto,
+        'shutdown_time': var_conf_shutdown_time,
+        'shutdown_temp': var_conf_shutdown_temp,
+        'runout_pause': var_conf_runout_pause,
+        'gpio_rly1': var_gpio_rly1,
+        'gpio_rly2': var_gpio_rly2,
+        'gpio_led0': var_gpio_led0,
+        'gpio_led1': var_gpio_led1,
+        'gpio_led2': var_gpio_led2,
+        'gpio_sen0': var_gpio_sen0,
+        'cache': {},                     # Shared printer state, see cache_store()
+        'cache_time': 0.0,
+        'cache_lock': threading.Lock(),
+        'telemetry': {},                 # Tool/bed -> temperature ring, see telemetry_add()
+        'telemetry_lock': threading.Lock(),
+        'event_state': None,             # Push event subscriber state, see events_set_state()
+        'event_tool0': None,
+        'event_changed': 0.0,
+        'event_started': False,          # PrintStarted pushed since the monitor last looked
+        'event_signal': threading.Event(), # Set on every push event state change, see connect_ready()
+        'wake': threading.Event(),       # Wakes the monitor early
+        'poll': {'interval': var_conf_poll_fast, 'reason': 'start', 'boost': 0.0, 'failures': 0},
+        'ready': threading.Event(),      # Set once OctoPrint answered, see conwait()
+        'ready_connect': [],
+        'actions': Queue(),              # Gestures waiting for this printer's button worker
+        'runout': False,                 # Confirmed filament runout, see filament_loop()
+        'runout_edge': threading.Event(),
+        'runout_edge_time': 0.0,
+        'monitor': None,
+        'events': None,                  # Push event subscriber, started once by the first monitor run
+        'state': 'none',                 # Detailed state the monitor last saw
+        'resume': None,                  # Persisted relay/print state found at startup, see state_load()
+        'shutdown': None,                # Automatic shutdown phase (countdown, cooling, off), see shutdown_run()
+        'shutdown_abort': threading.Event(),
+    }
+
+def printer_bind(var_printer):
+    var_printer_local.printer = var_printer
+
+def printer_ctx():
+    return var_printer_local.printer
+
+# Run var_target bound to var_printer, for one-off threads
+def printer_run(var_printer, var_target, *var_args):
+    printer_bind(var_printer)
+    var_target(*var_args)
+
+# Persisted State
+# In service mode the relay levels and last print state of every printer are
+# written to var_conf_state_file whenever they change (write, then rename).
+# A daemon restarted after a crash, a watchdog kill or systemctl restart reads
+# it back and sets the relays up as they were, so a running print keeps its
+# power. The file lives in /run and so never outlives a reboot.
+var_state_saved = [None]
+var_state_lock = threading.Lock()
+
+def state_save():
+    if (var_conf_service != 1) or (not var_conf_state_file):
+        return
+    var_state = {}
+    for var_printer in var_printers:
+        var_state[var_printer['name']] = {'rly1': GPIO.input(var_printer['gpio_rly1']), 'rly2': GPIO.input(var_printer['gpio_rly2']), 'state': var_printer['state']}
+    with var_state_lock:
+        if var_state == var_state_saved[0]:
+            return
+        var_state_saved[0] = var_state
+        try:
+            with open(var_conf_state_file + '.tmp', 'w') as stream:
+                json.dump(var_state, stream)
+            os.rename(var_conf_state_file + '.tmp', var_conf_state_file)
+        except (IOError, OSError) as e:
+            log('State', "Error: Can't save {} ({})".format(var_conf_state_file, e))
+
+def state_load():
+    if (var_conf_service != 1) or (not var_conf_state_file) or (not os.path.exists(var_conf_state_file)):
+        return
+    try:
+        with open(var_conf_state_file) as stream:
+            var_state = json.load(stream)
+    except (IOError, OSError, ValueError) as e:
+        log('State', "Error: Can't read {} ({})".format(var_conf_state_file, e))
+        return
+    for var_printer in var_printers:
+        var_resume = var_state.get(var_printer['name'])
+        if isinstance(var_resume, dict) and (var_resume.get('rly1') == GPIO.LOW):
+            var_printer['resume'] = var_resume
+            var_printer['state'] = var_resume.get('state', 'none')
+            log('State', "Resuming with the printer powered ({})".format(var_printer['state']), printer=var_printer['name'], action='resume')
+
+# Exit keeping the relays as they are, for systemd to restart the daemon
+def service_exit(var_code):
+    state_save()
+    stats_flush()
+    sd_notify('STOPPING=1')
+    log('Task', "Exiting, relays left as they are for the restart", action='service_exit')
+    log_flush()
+    os._exit(var_code)
+
+# Event Log
+# log() appends a record (monotonic and wall timestamps, level, source,
+# message and fields such as pin, action, state_from/state_to, latency) to an
+# in-memory ring buffer and returns; log_worker() writes the records as JSON
+# lines to var_conf_log_file, rotating by size, and echoes them to stdout. When
+# the buffer is full the oldest records are dropped, so logging never blocks.
+var_log_ring = deque(maxlen=var_conf_log_buffer)
+var_log_wake = threading.Event()
+var_log_lock = threading.Lock()
+var_log_stream = [None, False] # Open log file, and whether opening it has failed
+
+def log(var_source, var_message, **var_fields):
+    var_record = {'ts': round(monotonic(), 4), 'time': round(time(), 3), 'source': var_source, 'msg': var_message}
+    var_record['level'] = 'error' if var_message.startswith('Error') else 'info'
+    if getattr(var_printer_local, 'printer', None) is not None:
+        var_record['printer'] = var_printer_local.printer['name']
+    var_record.update((var_key, var_value) for var_key, var_value in var_fields.items() if var_value is not None)
+    if len(var_log_ring) == var_log_ring.maxlen:
+        metric_inc('controlpad_log_dropped_total')
+    var_log_ring.append(var_record)
+    var_log_wake.set()
+
+def log_rotate():
+    var_log_stream[0].close()
+    var_log_stream[0] = None
+    for var_index in range(var_conf_log_keep - 1, 0, -1):
+        if os.path.exists('{}.{}'.format(var_conf_log_file, var_index)):
+            os.rename('{}.{}'.format(var_conf_log_file, var_index), '{}.{}'.format(var_conf_log_file, var_index + 1))
+    if var_conf_log_keep > 0:
+        os.rename(var_conf_log_file, var_conf_log_file + '.1')
+    else:
+        os.remove(var_conf_log_file)
+
+# Write out everything buffered so far
+def log_flush():
+    with var_log_lock:
+        var_lines = []
+        var_console = []
+        while var_log_ring:
+            var_record = var_log_ring.popleft()
+            var_lines.append(json.dumps(var_record, sort_keys=True))
+            if var_conf_log_console == 1:
+                var_source = var_record['source']
+                if ('printer' in var_record) and (len(var_printers) > 1):
+                    var_source = '{} [{}]'.format(var_source, var_record['printer'])
+                if 'pin' in var_record:
+                    var_console.append("{}, GPIO {}, {}".format(var_source, var_record['pin'], var_record['msg']))
+                else:
+                    var_console.append("{}, {}".format(var_source, var_record['msg']))
+                if 'trace' in var_record:
+                    var_console.append(var_record['trace'].rstrip())
+        if var_console:
+            sys.stdout.write('\n'.join(var_console) + '\n')
+            sys.stdout.flush()
+        if (not var_lines) or (not var_conf_log_file) or var_log_stream[1]:
+            return
+        try:
+            if var_log_stream[0] is None:
+                var_log_stream[0] = open(var_conf_log_file, 'a')
+            var_log_stream[0].write('\n'.join(var_lines) + '\n')
+            var_log_stream[0].flush()
+            if var_log_stream[0].tell() >= var_conf_log_size:
+                log_rotate()
+        except (IOError, OSError) as e:
+            var_log_stream[1] = True
+            sys.stdout.write("Log, Error: Can't write {} ({}), logging to stdout only\n".format(var_conf_log_file, e))
+
+def log_worker():
+    while True:
+        watchdog_beat(1.0)
+        var_log_wake.wait(1.0)
+        var_log_wake.clear()
+        log_flush()
+
+# Metrics
+# Counters, gauges and latency histograms kept in memory and served in the
+# Prometheus text format at /metrics by metrics_serve(). Series are keyed by
+# (name, labels), labels being a tuple of (name, value) pairs fixed in code.
+var_metrics_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+var_metrics_help = {         # Metric name -> (type, help)
+    'controlpad_api_request_seconds': ('histogram', 'OctoPrint REST request latency'),
+    'controlpad_api_errors_total': ('counter', 'OctoPrint REST requests that failed'),
+    'controlpad_api_retries_total': ('counter', 'OctoPrint REST requests sent again after a failure'),
+    'controlpad_pull_seconds': ('histogram', 'printer_pull() latency by command and source'),
+    'controlpad_push_seconds': ('histogram', 'printer_push() latency by command'),
+    'controlpad_push_errors_total': ('counter', 'printer_push() commands that failed'),
+    'controlpad_monitor_loop_seconds': ('histogram', 'Monitor pass duration, excluding the wait between passes'),
+    'controlpad_state_change_seconds': ('histogram', 'Time from a printer state change being seen to the monitor acting on it'),
+    'controlpad_button_classify_seconds': ('histogram', 'Time from the deciding button edge or hold deadline to the gesture being dispatched'),
+    'controlpad_button_action_seconds': ('histogram', 'Time from the button edge to its action finishing'),
+    'controlpad_sound_dropped_total': ('counter', 'Sounds dropped because the queue was full'),
+    'controlpad_task_restarts_total': ('counter', 'Task threads restarted after a crash'),
+    'controlpad_log_dropped_total': ('counter', 'Log records dropped because the buffer was full'),
+    'controlpad_filament_runout': ('gauge', 'Filament sensor state after filtering (1 runout)'),
+    'controlpad_filament_runouts_total': ('counter', 'Confirmed filament runouts'),
+    'controlpad_filament_glitches_total': ('counter', 'Filament sensor edges the filter rejected'),
+    'controlpad_filament_pause_seconds': ('histogram', 'Time from the first sensor edge to the runout pause being sent'),
+    'controlpad_temperature_celsius': ('gauge', 'Latest actual temperature by tool and bed'),
+    'controlpad_temperature_target_celsius': ('gauge', 'Latest target temperature by tool and bed'),
+    'controlpad_control_requests_total': ('counter', 'Control socket requests by command'),
+    'controlpad_worker_heartbeat_age_seconds': ('gauge', 'Time since each worker last reported progress'),
+    'controlpad_worker_stalls_total': ('counter', 'Workers that missed their heartbeat deadline'),
+    'controlpad_connect_seconds': ('histogram', 'Time from a connect attempt starting to the printer being operational or the attempt failing, by attempt and result'),
+    'controlpad_shutdowns_total': ('counter', 'Automatic shutdowns by result (off, timeout, aborted)'),
+    'controlpad_relay_on': ('gauge', 'Printer relay state (1 on)'),
+    'controlpad_poll_interval_seconds': ('gauge', 'Monitor poll interval by the reason it was picked (0 for the reasons not in effect)'),
+    'controlpad_relay_on_seconds_total': ('counter', 'Time the printer relay has been on'),
+    'controlpad_startup_seconds': ('gauge', 'Time from script start to inputs live and to OctoPrint answering'),
+    'controlpad_start_time_seconds': ('gauge', 'Daemon start time (Unix seconds)'),
+}
+var_metrics = {}             # (name, labels) -> value, or [bucket counts..., sum, count] for histograms
+var_metrics_lock = threading.Lock()
+
+def metric_inc(var_name, var_labels=(), var_value=1):
+    with var_metrics_lock:
+        var_metrics[(var_name, var_labels)] = var_metrics.get((var_name, var_labels), 0) + var_value
+
+def metric_set(var_name, var_labels, var_value):
+    with var_metrics_lock:
+        var_metrics[(var_name, var_labels)] = var_value
+
+def metric_observe(var_name, var_labels, var_seconds):
+    with var_metrics_lock:
+        var_series = var_metrics.setdefault((var_name, var_labels), [0] * (len(var_metrics_buckets) + 2))
+        for var_index, var_bound in enumerate(var_metrics_buckets):
+            if var_seconds <= var_bound:
+                var_series[var_index] = var_series[var_index] + 1
+        var_series[-2] = var_series[-2] + var_seconds
+        var_series[-1] = var_series[-1] + 1
+
+# Number of observations (histograms) or total (counters) across all labels
+def metric_total(var_name):
+    with var_metrics_lock:
+        var_total = 0
+        for (var_key, var_labels), var_value in var_metrics.items():
+            if var_key == var_name:
+                var_total = var_total + (var_value[-1] if isinstance(var_value, list) else var_value)
+        return var_total
+
+def metrics_labels(var_labels, var_extra=()):
+    var_labels = var_labels + var_extra
+    if not var_labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(var_key, str(var_value).replace('\\', '\\\\').replace('"', '\\"')) for var_key, var_value in var_labels) + '}'
+
+def metrics_text():
+    with var_metrics_lock:
+        var_series = sorted(var_metrics.items(), key=lambda var_item: (var_item[0][0], tuple((var_key, str(var_value)) for var_key, var_value in var_item[0][1])))  # Label values may mix types
+    var_lines = []
+    var_written = set()
+    for (var_name, var_labels), var_value in var_series:
+        if var_name not in var_written:
+            var_type, var_help = var_metrics_help.get(var_name, ('untyped', var_name))
+            var_lines.append('# HELP {} {}'.format(var_name, var_help))
+            var_lines.append('# TYPE {} {}'.format(var_name, var_type))
+            var_written.add(var_name)
+        if isinstance(var_value, list):
+            for var_index, var_bound in enumerate(var_metrics_buckets):
+                var_lines.append('{}_bucket{} {}'.format(var_name, metrics_labels(var_labels, (('le', var_bound),)), var_value[var_index]))
+            var_lines.append('{}_bucket{} {}'.format(var_name, metrics_labels(var_labels, (('le', '+Inf'),)), var_value[-1]))
+            var_lines.append('{}_sum{} {:.6f}'.format(var_name, metrics_labels(var_labels), var_value[-2]))
+            var_lines.append('{}_count{} {}'.format(var_name, metrics_labels(var_labels), var_value[-1]))
+        else:
+            var_lines.append('{}{} {}'.format(var_name, metrics_labels(var_labels), var_value))
+    return '\n'.join(var_lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        var_body = metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(var_body)))
+        self.end_headers()
+        self.wfile.write(var_body)
+
+    def log_message(self, *var_args):
+        pass
+
+def metrics_serve():
+    try:
+        server = HTTPServer((var_conf_metrics_host, var_conf_metrics_port), MetricsHandler)
+    except socket.error as e:
+        log('Metrics', "Error: Can't listen on {}:{} ({})".format(var_conf_metrics_host, var_conf_metrics_port, e))
+        return
+    log('Metrics', "Serving http://{}:{}/metrics".format(var_conf_metrics_host, var_conf_metrics_port))
+    server.serve_forever()
+
+# Usage Statistics
+# stats_add() adds to an in-memory counter keyed by (printer, kind, name) and
+# returns. stats_worker() writes the counters that changed every
+# var_conf_stats_flush seconds, one row each in a single transaction, to an
+# append-only SQLite table in WAL mode. A monitor pass every 250 ms costs a dict
+# update, and the SD card sees a handful of rows a minute. Totals are sums over
+# the rows, see controlpad-stats.py. Kinds and names:
+#   power   printer, fan: seconds the relay was on
+#   print   started, paused, resumed, ended: monitor state transitions
+#   job     done, cancelled, failed: print outcomes, from push events only
+#   button  action: button gestures (hold repeats count once)
+#   socket  action: control socket actions
+var_stats = {}
+var_stats_lock = threading.Lock()
+var_stats_write_lock = threading.Lock()
+var_stats_db = [None, False] # Open database, and whether opening it has failed
+
+def stats_add(var_kind, var_name, var_value=1):
+    if not var_conf_stats_file:
+        return
+    var_key = (printer_ctx()['name'], var_kind, var_name)
+    with var_stats_lock:
+        var_stats[var_key] = var_stats.get(var_key, 0) + var_value
+
+def stats_open():
+    var_dir = os.path.dirname(var_conf_stats_file)
+    if var_dir and (not os.path.isdir(var_dir)):
+        os.makedirs(var_dir)
+    db = sqlite3.connect(var_conf_stats_file, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')   # WAL stays consistent, a power cut may lose the last flush
+    db.execute('CREATE TABLE IF NOT EXISTS usage (time REAL NOT NULL, printer TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL, value REAL NOT NULL)')
+    db.execute('CREATE INDEX IF NOT EXISTS usage_time ON usage (time)')
+    db.commit()
+    return db
+
+# Write out everything counted so far
+def stats_flush():
+    with var_stats_write_lock:
+        with var_stats_lock:
+            var_rows = [(round(time(), 3), var_key[0], var_key[1], var_key[2], var_value) for var_key, var_value in var_stats.items() if var_value]
+            var_stats.clear()
+        if (not var_rows) or var_stats_db[1]:
+            return
+        try:
+            if var_stats_db[0] is None:
+                var_stats_db[0] = stats_open()
+            with var_stats_db[0]:
+                var_stats_db[0].executemany('INSERT INTO usage VALUES (?, ?, ?, ?, ?)', var_rows)
+        except (sqlite3.Error, IOError, OSError) as e:
+            var_stats_db[1] = True
+            log('Stats', "Error: Can't write {} ({}), usage statistics disabled".format(var_conf_stats_file, e))
+
+def stats_worker():
+    while not var_stop.is_set():
+        watchdog_beat(var_conf_stats_flush)
+        var_stop.wait(var_conf_stats_flush)
+        stats_flush()
+
+# GPIO Backends
+# Every backend exposes the subset of the RPi.GPIO module API this script uses
+# (setup, input, output, PWM, add_event_detect, cleanup and the constants), so
+# the rest of the script only ever talks to GPIO. Selected at startup by
+# var_conf_gpio_backend: rpi (RPi.GPIO), sim (software simulator) or gpiod
+# (Linux GPIO character device through the libgpiod v1 Python bindings).
+class BaseGPIO(object):
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_UP = 22
+    PUD_DOWN = 21
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def setmode(self, var_mode):
+        pass
+
+    def setwarnings(self, var_flag):
+        pass
+
+class SimPWM(object):
+    def __init__(self, var_gpio, var_hz):
+        self.var_gpio = var_gpio
+        self.var_hz = var_hz
+        self.var_running = False
+
+    def start(self, var_dutycycle):
+        self.var_running = True
+        GPIO.tone(self.var_gpio, self.var_hz)
+
+    def ChangeFrequency(self, var_hz):
+        self.var_hz = var_hz
+        if self.var_running:
+            GPIO.tone(self.var_gpio, var_hz)
+
+    def ChangeDutyCycle(self, var_dutycycle):
+        pass
+
+    def stop(self):
+        self.var_running = False
+        GPIO.tone(self.var_gpio, 0)
+
+# Simulated GPIO
+# Output writes are appended with timestamps (seconds
+# since start) to CONTROLPAD_SIM_RECORD when set. Inputs are driven either from
+# stdin or from the timeline file in CONTROLPAD_SIM_SCRIPT (lines of
+# "<seconds after ready> <command>"), see sim_command().
+class SimGPIO(BaseGPIO):
+    PWM = SimPWM
+
+    def __init__(self):
+        self.var_levels = [0] * 64
+        self.var_pwm = {}               # GPIO -> PWM frequency now, 0 when stopped
+        self.var_pwm_heard = {}         # GPIO -> PWM frequencies started since the last input
+        self.var_callbacks = {}
+        self.var_start = time()
+        self.var_record = None
+        if os.environ.get('CONTROLPAD_SIM_RECORD'):
+            self.var_record = open(os.environ['CONTROLPAD_SIM_RECORD'], 'a')
+        self.var_input_time = self.var_start
+        self.var_failures = 0
+
+    def setup(self, var_gpio, var_direction, initial=None, pull_up_down=None):
+        if initial is not None:
+            self.output(var_gpio, initial)
+        elif pull_up_down == self.PUD_UP:
+            self.var_levels[var_gpio] = self.HIGH
+
+    def input(self, var_gpio):
+        return self.var_levels[var_gpio]
+
+    def output(self, var_gpio, var_level):
+        self.var_levels[var_gpio] = int(var_level)
+        self.record(var_gpio, int(var_level))
+
+    def tone(self, var_gpio, var_hz):
+        self.var_pwm[var_gpio] = var_hz
+        if var_hz:
+            self.var_pwm_heard.setdefault(var_gpio, set()).add(var_hz)
+        self.record(var_gpio, 'pwm {}'.format(var_hz) if var_hz else 'stop')
+
+    def record(self, var_gpio, var_value):
+        if self.var_record is not None:
+            self.var_record.write('{:.4f} {} {}\n'.format(time() - self.var_start, var_gpio, var_value))
+            self.var_record.flush()
+
+    def add_event_detect(self, var_gpio, var_edge, callback=None, bouncetime=None):
+        self.var_callbacks[var_gpio] = (var_edge, callback)
+
+    def remove_event_detect(self, var_gpio):
+        self.var_callbacks.pop(var_gpio, None)
+
+    def cleanup(self):
+        self.var_callbacks = {}
+
+    def drive(self, var_gpio, var_level):
+        self.var_input_time = time()
+        self.var_pwm_heard = {}
+        if self.var_levels[var_gpio] == var_level:
+            return
+        self.var_levels[var_gpio] = var_level
+        var_edge, callback = self.var_callbacks.get(var_gpio, (None, None))
+        if (callback is not None) and (var_edge in (self.BOTH, (self.FALLING, self.RISING)[var_level])):
+            callback(var_gpio)
+
+    # Timeline commands, one per line:
+    #   press <gpio> / release <gpio>         drive a pull-up input low / high
+    #   expect <gpio> <level> <within>        wait up to <within> seconds for an output
+    #                                         level and report the latency since the last input
+    #   expect <gpio> pwm <hz> <within>       same for a PWM tone started since the last
+    #                                         input (pwm 0: PWM stopped)
+    #   end                                   report and exit, non-zero if any expect failed
+    def sim_command(self, var_words):
+        if (len(var_words) == 2) and (var_words[0] in ('press', 'release')):
+            self.drive(int(var_words[1]), int(var_words[0] == 'release'))
+        elif (len(var_words) in (4, 5)) and (var_words[0] == 'expect'):
+            var_gpio, var_within = int(var_words[1]), float(var_words[-1])
+            if len(var_words) == 5:
+                var_hz = int(var_words[3])
+                var_wanted = 'pwm {}'.format(var_hz)
+                var_check = lambda: (var_hz in self.var_pwm_heard.get(var_gpio, ())) if var_hz else (not self.var_pwm.get(var_gpio))
+            else:
+                var_level = int(var_words[2])
+                var_wanted = var_level
+                var_check = lambda: self.var_levels[var_gpio] == var_level
+            while not var_check():
+                if time() - self.var_input_time > var_within:
+                    log('Sim', "Error: not {} within {}s".format(var_wanted, var_within), pin=var_gpio, action='expect_failed')
+                    self.var_failures = self.var_failures + 1
+                    return
+                sleep(0.001)
+            log('Sim', "OK: {} after {:.1f}ms".format(var_wanted, (time() - self.var_input_time) * 1000), pin=var_gpio, action='expect_ok', latency=round(time() - self.var_input_time, 4))
+        elif var_words == ['end']:
+            log('Sim', "Timeline finished, {} failed expectation(s)".format(self.var_failures))
+            log_flush()
+            os._exit(int(self.var_failures > 0))
+
+    def console(self):
+        if os.environ.get('CONTROLPAD_SIM_SCRIPT'):
+            with open(os.environ['CONTROLPAD_SIM_SCRIPT']) as stream:
+                var_timeline = [var_line.split('#')[0].split() for var_line in stream]
+            var_t0 = time()
+            for var_words in var_timeline:
+                if var_words:
+                    sleep(max(var_t0 + float(var_words[0]) - time(), 0))
+                    self.sim_command(var_words[1:])
+        else:
+            for var_line in iter(sys.stdin.readline, ''):
+                self.sim_command(var_line.split())
+
+class GpiodPWM(object):
+    def __init__(self, var_gpio, var_hz):
+        self.var_line = GPIO.var_lines[var_gpio]
+        self.var_hz = var_hz
+        self.var_dutycycle = 50
+        self.var_running = False
+        self.var_thread = None
+
+    # One toggling thread per line: a restart waits for the previous one to end
+    def start(self, var_dutycycle):
+        self.stop()
+        self.var_dutycycle = var_dutycycle
+        self.var_running = True
+        self.var_thread = thread_start(self.run)
+
+    def run(self):
+        while self.var_running:
+            var_period = 1.0 / self.var_hz
+            self.var_line.set_value(1)
+            sleep(var_period * self.var_dutycycle / 100.0)
+            self.var_line.set_value(0)
+            sleep(var_period * (100 - self.var_dutycycle) / 100.0)
+
+    def ChangeFrequency(self, var_hz):
+        self.var_hz = var_hz
+
+    def ChangeDutyCycle(self, var_dutycycle):
+        self.var_dutycycle = var_dutycycle
+
+    def stop(self):
+        self.var_running = False
+        if self.var_thread is not None:
+            self.var_thread.join()
+            self.var_thread = None
+
+# libgpiod GPIO
+# Inputs are requested for both edges up front, so reads and edge callbacks
+# share one line request. PWM is toggled in software.
+class GpiodGPIO(BaseGPIO):
+    PWM = GpiodPWM
+
+    def __init__(self):
+        import gpiod
+        self.gpiod = gpiod
+        self.var_chip = gpiod.Chip('gpiochip0')
+        self.var_lines = {}
+        self.var_watching = {}
+
+    def setup(self, var_gpio, var_direction, initial=None, pull_up_down=None):
+        var_line = self.var_chip.get_line(var_gpio)
+        if var_direction == self.OUT:
+            var_line.request(consumer='controlpad', type=self.gpiod.LINE_REQ_DIR_OUT, default_vals=[initial or 0])
+        else:
+            var_flags = 0
+            if pull_up_down == self.PUD_UP:
+                var_flags = self.gpiod.LINE_REQ_FLAG_BIAS_PULL_UP
+            elif pull_up_down == self.PUD_DOWN:
+                var_flags = self.gpiod.LINE_REQ_FLAG_BIAS_PULL_DOWN
+            var_line.request(consumer='controlpad', type=self.gpiod.LINE_REQ_EV_BOTH_EDGES, flags=var_flags)
+        self.var_lines[var_gpio] = var_line
+
+    def input(self, var_gpio):
+        return self.var_lines[var_gpio].get_value()
+
+    def output(self, var_gpio, var_level):
+        self.var_lines[var_gpio].set_value(int(var_level))
+
+    def add_event_detect(self, var_gpio, var_edge, callback=None, bouncetime=None):
+        self.var_watching[var_gpio] = True
+        thread_start(self.watch, var_gpio, var_edge, callback)
+
+    def watch(self, var_gpio, var_edge, callback):
+        var_line = self.var_lines[var_gpio]
+        var_wanted = {
+            self.RISING: (self.gpiod.LineEvent.RISING_EDGE,),
+            self.FALLING: (self.gpiod.LineEvent.FALLING_EDGE,),
+            self.BOTH: (self.gpiod.LineEvent.RISING_EDGE, self.gpiod.LineEvent.FALLING_EDGE),
+        }[var_edge]
+        while self.var_watching.get(var_gpio):
+            if var_line.event_wait(sec=1):
+                if var_line.event_read().type in var_wanted:
+                    callback(var_gpio)
+
+    def remove_event_detect(self, var_gpio):
+        self.var_watching.pop(var_gpio, None)
+
+    def cleanup(self):
+        self.var_watching = {}
+        for var_line in self.var_lines.values():
+            var_line.release()
+        self.var_lines = {}
+
+def gpio_backend(var_backend):
+    if var_backend == 'sim':
+        return SimGPIO()
+    elif var_backend == 'gpiod':
+        return GpiodGPIO()
+    else:
+        import RPi.GPIO
+        return RPi.GPIO
+
+GPIO = gpio_backend(var_conf_gpio_backend)
+
 # Setup GPIOs
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
-GPIO.setup(var_gpio_rly1, GPIO.OUT, initial=GPIO.HIGH)
-GPIO.setup(var_gpio_rly2, GPIO.OUT, initial=GPIO.HIGH)
-GPIO.setup(var_gpio_spk1, GPIO.OUT)
-GPIO.setup(var_gpio_led1, GPIO.OUT, initial=GPIO.LOW)
-GPIO.setup(var_gpio_led2, GPIO.OUT, initial=GPIO.LOW)
-GPIO.setup(var_gpio_led0, GPIO.OUT, initial=GPIO.LOW)
-GPIO.setup(var_gpio_btn0, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(var_gpio_btn1, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(var_gpio_btn2, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(var_gpio_btn3, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(var_gpio_btn4, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.setup(var_gpio_sen0, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+def gpio_setup():
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(False)
+    GPIO.setup(var_gpio_spk1, GPIO.OUT)
+    for var_printer in var_printers:
+        var_resume = var_printer['resume'] or {}
+        GPIO.setup(var_printer['gpio_rly1'], GPIO.OUT, initial=var_resume.get('rly1', GPIO.HIGH))
+        GPIO.setup(var_printer['gpio_rly2'], GPIO.OUT, initial=var_resume.get('rly2', GPIO.HIGH))
+        GPIO.setup(var_printer['gpio_led1'], GPIO.OUT, initial=GPIO.LOW)
+        GPIO.setup(var_printer['gpio_led2'], GPIO.OUT, initial=GPIO.LOW)
+        GPIO.setup(var_printer['gpio_led0'], GPIO.OUT, initial=GPIO.LOW)
+        GPIO.setup(var_printer['gpio_sen0'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
+    for var_gpio in var_buttons:
+        GPIO.setup(var_gpio, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
 # Get OctoPrint API Key
-with open("/home/pi/.octoprint/config.yaml") as stream:
-    var_yaml_string = yaml.load(stream)
-    var_api_key = str(var_yaml_string['api']['key'])
-    print("OctoPrint API Key: {}").format(var_api_key)
+# Scans the config lines for the key under the top-level api: section instead
+# of parsing the whole file, PyYAML is only imported when the scan can't find it.
+# A printer with api_key set in the panel layout skips this.
+def api_key_scan(var_path):
+    var_section = False
+    var_indent = None
+    with open(var_path) as stream:
+        for var_line in stream:
+            var_text = var_line.split(' #')[0].rstrip()
+            if (not var_text.strip()) or var_text.lstrip().startswith('#'):
+                continue
+            if var_text[0] not in (' ', '\t'):
+                var_section = (var_text == 'api:')
+                var_indent = None
+            elif var_section:
+                if var_indent is None:
+                    var_indent = len(var_text) - len(var_text.lstrip())
+                if (len(var_text) - len(var_text.lstrip()) == var_indent) and var_text.lstrip().startswith('key:'):
+                    return var_text.lstrip()[4:].strip().strip('"\'') or None
+    return None
+
+def api_key_load(var_printer):
+    if var_printer['api_key'] is None:
+        var_printer['api_key'] = api_key_scan(var_printer['api_config'])
+    if var_printer['api_key'] is None:
+        import yaml
+        with open(var_printer['api_config']) as stream:
+            var_printer['api_key'] = str(yaml.safe_load(stream)['api']['key'])
+    log('API', "OctoPrint API Key: ...{}".format(var_printer['api_key'][-4:]), printer=var_printer['name'])  # Tail only, the log outlives the console
 
 # Define Beep Codes
-def pwm_beep(var_gpio, var_hz, var_sustain, var_pause, var_dutycycle=50):
-    p = GPIO.PWM(var_gpio, var_hz)
-    p.start(var_dutycycle)
-    sleep(var_sustain)
-    p.stop()
-    sleep(var_pause)
-
-def beep(var_beeptype='beep'):
-    if var_beeptype == 'beep':
-        pwm_beep(var_gpio_spk1, 400, 0.07, 0)     #GPIO, Hz, Sustain, Pause, Duty Cycle
-    elif var_beeptype == 'up':
-        pwm_beep(var_gpio_spk1, 200, 0.07, 0.05)  #GPIO, Hz, Sustain, Pause, Duty Cycle
-        pwm_beep(var_gpio_spk1, 460, 0.08, 0)     #GPIO, Hz, Sustain, Pause, Duty Cycle
-    elif var_beeptype == 'down':
-        pwm_beep(var_gpio_spk1, 460, 0.07, 0.05)  #GPIO, Hz, Sustain, Pause, Duty Cycle
-        pwm_beep(var_gpio_spk1, 180, 0.08, 0)     #GPIO, Hz, Sustain, Pause, Duty Cycle
-    elif var_beeptype == 'error':
-        pwm_beep(var_gpio_spk1, 80, 0.09, 0.05)   #GPIO, Hz, Sustain, Pause, Duty Cycle
-        pwm_beep(var_gpio_spk1, 50, 0.09, 0)      #GPIO, Hz, Sustain, Pause, Duty Cycle
+# Each sound is a precomputed sequence of (Hz, Sustain, Pause) tones. beep() only
+# queues the name; sound_worker() plays queued sounds on one reused PWM channel,
+# scheduling every tone against absolute deadlines so the sequence doesn't drift.
+# A sound already waiting in the queue is coalesced, and new sounds are dropped
+# while var_conf_sound_queue sounds are waiting.
+var_sounds = {
+    'beep':     ((400, 0.07, 0),),
+    'up':       ((200, 0.07, 0.05), (460, 0.08, 0)),
+    'down':     ((460, 0.07, 0.05), (180, 0.08, 0)),
+    'error':    ((80, 0.09, 0.05), (50, 0.09, 0)),
+    'startup':  ((600, 0.18, 0.05), (600, 0.07, 0.05), (300, 0.08, 0.05), (600, 0.09, 0.05), (1800, 0.07, 0)),
+    'shutdown': ((1800, 0.18, 0.05), (600, 0.07, 0.05), (300, 0.08, 0.05), (600, 0.09, 0.05), (200, 0.07, 0)),
+}
+var_sound_dutycycle = 50
+var_sound_queue = Queue()
+var_sound_pending = []       # Names waiting in var_sound_queue
+var_sound_lock = threading.Lock()
+var_sound_idle = threading.Event()
+
+def sound_worker():
+    p = None
+    while not var_stop.is_set():
+        watchdog_beat(None)
+        var_beeptype = var_sound_queue.get()
+        watchdog_beat()
+        with var_sound_lock:
+            var_sound_pending.remove(var_beeptype)
+        var_deadline = time()
+        for var_hz, var_sustain, var_pause in var_sounds[var_beeptype]:
+            if p is None:
+                p = GPIO.PWM(var_gpio_spk1, var_hz)
+            else:
+                p.ChangeFrequency(var_hz)
+            p.start(var_sound_dutycycle)
+            var_deadline = var_deadline + var_sustain
+            sleep(max(var_deadline - time(), 0))
+            p.stop()
+            var_deadline = var_deadline + var_pause
+            sleep(max(var_deadline - time(), 0))
+        with var_sound_lock:
+            if not var_sound_pending:
+                var_sound_idle.set()
+
+def beep(var_beeptype='beep', var_wait=False):
+    if var_beeptype not in var_sounds:
+        log('Sound', "Error: {} is not a valid beep type. Please use one of the following: {}".format(var_beeptype, ', '.join(sorted(var_sounds))))
+        return
+    with var_sound_lock:
+        if var_beeptype in var_sound_pending:
+            pass
+        elif len(var_sound_pending) >= var_conf_sound_queue:
+            log('Sound', "Queue full, dropped {}".format(var_beeptype))
+            metric_inc('controlpad_sound_dropped_total', (('sound', var_beeptype),))
+        else:
+            var_sound_pending.append(var_beeptype)
+            var_sound_idle.clear()
+            var_sound_queue.put(var_beeptype)
+    if var_wait:
+        var_sound_idle.wait(2.0)
+
+# LED Animation
+# led_set() declares what an LED shows: on, off, blink (square wave at var_hz,
+# starting on), pulse (a short flash once per period) or countdown (var_count
+# blinks starting off, then off). Static changes are written immediately, and
+# led_worker() renders the animations from one timer thread, sleeping until the
+# next LED edge, so no caller ever sleeps through an animation.
+var_led_states = {}          # GPIO -> (mode, Hz, start timestamp, count)
+var_led_levels = {}          # GPIO -> level last written
+var_led_lock = threading.Lock()
+var_led_wake = threading.Event()
+
+def led_level(var_state, var_now):
+    var_mode, var_hz, var_start, var_count = var_state
+    if var_mode == 'on':
+        return 1, None
+    elif var_mode == 'off':
+        return 0, None
+    var_period = 1.0 / var_hz
+    var_cycle = int((var_now - var_start) // var_period)
+    if (var_mode == 'countdown') and (var_cycle >= var_count):
+        return 0, None
+    var_cycle_start = var_start + (var_cycle * var_period)
+    var_width = var_period * (0.1 if var_mode == 'pulse' else 0.5)
+    var_first = var_now < var_cycle_start + var_width
+    if var_first:
+        var_change = var_cycle_start + var_width
     else:
-        print("{} is not a valid beep type. Please use one of the following: beep, up, down, error").format(var_beeptype)
+        var_change = var_cycle_start + var_period
+    return int(var_first != (var_mode == 'countdown')), var_change
+
+def led_render():
+    var_now = time() + 0.001     # Don't wake a hair early and render the old level again
+    var_next = None
+    for var_gpio, var_state in var_led_states.items():
+        var_level, var_change = led_level(var_state, var_now)
+        if var_led_levels.get(var_gpio) != var_level:
+            GPIO.output(var_gpio, var_level)
+            var_led_levels[var_gpio] = var_level
+        if (var_change is not None) and ((var_next is None) or (var_change < var_next)):
+            var_next = var_change
+    return var_next
+
+def led_worker():
+    while not var_stop.is_set():
+        with var_led_lock:
+            var_next = led_render()
+        if var_next is None:
+            watchdog_beat(60)
+            var_led_wake.wait(60)
+        else:
+            watchdog_beat(max(var_next - time(), 0))
+            var_led_wake.wait(max(var_next - time(), 0))
+        var_led_wake.clear()
+
+def led_set(var_gpio, var_mode, var_hz=1.0, var_count=0):
+    with var_led_lock:
+        var_state = var_led_states.get(var_gpio)
+        if (var_state is None) or ((var_state[0], var_state[1], var_state[3]) != (var_mode, var_hz, var_count)):
+            var_led_states[var_gpio] = (var_mode, var_hz, time(), var_count)
+            led_render()
+    var_led_wake.set()
+
+# OctoPrint REST API Client
+# Every pull/push goes to the bound printer's OctoPrint through a keep-alive
+# connection owned by the calling thread (one per OctoPrint address), so a slow
+# request in one task never queues behind another. Each call returns a result
+# dict: ok, status, data (parsed JSON), error, latency (Seconds)
+var_api_local = threading.local()
+
+def api_connection():
+    var_printer = printer_ctx()
+    var_address = (var_printer['api_host'], var_printer['api_port'])
+    var_pool = var_api_local.__dict__.setdefault('pool', {})
+    if var_pool.get(var_address) is None:
+        var_pool[var_address] = httplib.HTTPConnection(var_address[0], var_address[1], timeout=var_conf_api_timeout)
+    return var_pool[var_address]
+
+def api_close():
+    var_printer = printer_ctx()
+    var_address = (var_printer['api_host'], var_printer['api_port'])
+    var_pool = var_api_local.__dict__.setdefault('pool', {})
+    if var_pool.get(var_address) is not None:
+        var_pool[var_address].close()
+    var_pool[var_address] = None
+
+# Path as a metric label: no query, and SockJS session paths
+# (/sockjs/<server>/<session>/xhr_send) reduced to a fixed route
+def api_route(var_path):
+    var_path = var_path.split('?')[0]
+    if var_path.startswith('/sockjs/'):
+        return '/sockjs/' + var_path.rsplit('/', 1)[-1]
+    return var_path
+
+def api_request(var_method, var_path, var_body=None, var_timeout=None):
+    var_result = {'ok': False, 'status': 0, 'data': None, 'error': None, 'latency': 0.0}
+    var_headers = {'Content-Type': 'application/json', 'X-Api-Key': printer_ctx()['api_key']}
+    if var_body is not None:
+        var_body = json.dumps(var_body)
+    if var_timeout is None:
+        var_timeout = var_conf_api_timeout
+    var_start = time()
+    for var_attempt in range(2):    # Second attempt only if a kept-alive connection went stale
+        conn = api_connection()
+        conn.timeout = var_timeout
+        try:
+            if conn.sock is None:
+                conn.connect()
+                conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Headers and body go out as separate writes
+            conn.sock.settimeout(var_timeout)
+            conn.request(var_method, var_path, var_body, var_headers)
+            response = conn.getresponse()
+            var_raw = response.read()
+        except socket.timeout:
+            api_close()
+            var_result['error'] = 'timeout after {}s'.format(var_timeout)
+            break
+        except (httplib.HTTPException, socket.error) as e:
+            api_close()
+            var_result['error'] = 'connection error: {}'.format(e)
+            if var_attempt == 0:
+                metric_inc('controlpad_api_retries_total', (('printer', printer_ctx()['name']), ('path', api_route(var_path))))
+            continue
+        var_result['status'] = response.status
+        var_result['error'] = None
+        if var_raw:
+            try:
+                var_result['data'] = json.loads(var_raw.decode('utf-8'))
+            except ValueError:
+                var_result['data'] = var_raw
+        if 200 <= response.status < 300:
+            var_result['ok'] = True
+        else:
+            var_result['error'] = 'HTTP {}'.format(response.status)
+        if response.will_close:
+            api_close()
+        break
+    var_result['latency'] = time() - var_start
+    var_labels = (('printer', printer_ctx()['name']), ('method', var_method), ('path', api_route(var_path)))
+    metric_observe('controlpad_api_request_seconds', var_labels, var_result['latency'])
+    if not var_result['ok']:
+        metric_inc('controlpad_api_errors_total', var_labels)
+    return var_result
+
+def api_pull(var_path, var_keys):
+    for var_attempt in range(var_conf_api_retries):
+        var_result = api_request('GET', var_path)
+        if var_result['ok']:
+            try:
+                var_value = var_result['data']
+                for var_key in var_keys:
+                    var_value = var_value[var_key]
+                return str(var_value)
+            except (KeyError, IndexError, TypeError):
+                var_result['error'] = 'unexpected response'
+        log('API', "Error: GET {}, {} (attempt {}/{})".format(var_path, var_result['error'], var_attempt + 1, var_conf_api_retries), status=var_result['status'], latency=round(var_result['latency'], 4))
+        if var_attempt + 1 < var_conf_api_retries:
+            metric_inc('controlpad_api_retries_total', (('printer', printer_ctx()['name']), ('path', api_route(var_path))))
+            sleep(var_conf_api_retry_delay)
+    return 'Error'
+
+def api_push(var_path, var_body):
+    cache_clear()
+    var_result = api_request('POST', var_path, var_body)
+    if not var_result['ok']:
+        log('API', "Error: POST {}, {}".format(var_path, var_result['error']), status=var_result['status'], latency=round(var_result['latency'], 4))
+    return var_result
+
+# OctoPrint reports a state text of its own while a print changes over, and
+# "Printing from SD" for SD prints. printer_steady() turns these into the
+# steady state the monitor knows, so a pause or a cancel never passes through
+# Disconnected: the state being left while it is the last one seen, otherwise
+# the one listed.
+var_state_aliases = {         # Raw state -> steady state
+    'Printing from SD': 'Printing',
+}
+var_state_transitional = {    # Raw state while changing over -> steady state being left
+    'Starting': 'Operational',
+    'Starting print from SD': 'Operational',
+    'Pausing': 'Printing',
+    'Resuming': 'Paused',
+    'Cancelling': 'Printing',
+    'Finishing': 'Printing',
+}
+
+def printer_steady(var_state, var_previous):
+    if var_state in var_state_aliases:
+        return var_state_aliases[var_state]
+    if var_state in var_state_transitional:
+        if var_previous in ('Operational', 'Printing', 'Paused'):
+            return var_previous
+        return var_state_transitional[var_state]
+    return var_state
+
+# Reduce a raw OctoPrint state to the requested verbosity
+def printer_state(var_state, var_input1='none'):
+    if var_state == 'Error':
+        return 'Error'
+    if (var_input1 == 'basic') or (var_input1 == 'none'):
+        if (var_state == 'Operational') or (var_state == 'Printing') or (var_state == 'Paused'):
+            return 'Connected'
+        else:
+            return 'Disconnected'
+    elif var_input1 == 'detailed':
+        if (var_state != 'Operational') and (var_state != 'Printing') and (var_state != 'Paused'):
+            return 'Disconnected'
+        else:
+            return var_state
+    elif var_input1 == 'raw':
+        return var_state
+    else:
+        log('API', "Error: {} is not a valid verbosity. Please use one of the following: basic, detailed, raw".format(var_input1))
+        return 'Error'
+
+# Shared Printer State
+# The monitor is the regular fetcher: printer_refresh() stores a snapshot (raw
+# state, which is also the job state, tool0 target and actual temperature) each
+# pass, and telemetry_fresh() fetches one for an action whose temperature
+# reading has gone stale. printer_pull() answers from it while it is younger than
+# var_conf_cache_age. Every push clears it, so an action never checks its
+# result against the state from before the action. Kept per printer.
+def cache_store(var_snapshot):
+    var_printer = printer_ctx()
+    with var_printer['cache_lock']:
+        var_printer['cache'] = var_snapshot
+        var_printer['cache_time'] = time()
+    control_notify()
+
+def cache_read():
+    var_printer = printer_ctx()
+    with var_printer['cache_lock']:
+        if time() - var_printer['cache_time'] > var_conf_cache_age:
+            return None
+        return dict(var_printer['cache'])
+
+def cache_clear():
+    var_printer = printer_ctx()
+    with var_printer['cache_lock']:
+        var_printer['cache_time'] = 0.0
+
+# Temperature Telemetry
+# Every reading the monitor or the push events get (actual and target of each
+# tool and the bed) goes into a per-heater ring of arrays holding the last
+# var_conf_temp_samples readings. The heating rate is the least-squares slope
+# over the last var_conf_temp_trend readings, kept as running sums that each
+# reading entering or leaving the window updates, and the ETA to the target
+# follows from it. Actions read temperatures here instead of asking OctoPrint.
+# Kept per printer.
+def telemetry_ring(var_stamp):
+    var_size = max(var_conf_temp_samples, var_conf_temp_trend + 1)
+    return {
+        'time': array('d', [0.0]) * var_size,
+        'actual': array('d', [0.0]) * var_size,
+        'target': array('d', [0.0]) * var_size,
+        'index': 0,                      # Next slot to write
+        'count': 0,
+        'base': var_stamp,               # Time origin of the running sums
+        'sums': [0, 0.0, 0.0, 0.0, 0.0], # n, sum x, sum y, sum xy, sum xx over the trend window
+    }
+
+def telemetry_sum(var_ring, var_slot, var_sign):
+    var_sums = var_ring['sums']
+    var_x = var_ring['time'][var_slot] - var_ring['base']
+    var_y = var_ring['actual'][var_slot]
+    var_sums[0] = var_sums[0] + var_sign
+    var_sums[1] = var_sums[1] + (var_sign * var_x)
+    var_sums[2] = var_sums[2] + (var_sign * var_y)
+    var_sums[3] = var_sums[3] + (var_sign * var_x * var_y)
+    var_sums[4] = var_sums[4] + (var_sign * var_x * var_x)
+
+def telemetry_push(var_ring, var_stamp, var_actual, var_target):
+    var_size = len(var_ring['time'])
+    var_slot = var_ring['index']
+    if var_ring['count'] >= var_conf_temp_trend:
+        telemetry_sum(var_ring, (var_slot - var_conf_temp_trend) % var_size, -1)
+    var_ring['time'][var_slot] = var_stamp
+    var_ring['actual'][var_slot] = var_actual
+    var_ring['target'][var_slot] = var_target
+    telemetry_sum(var_ring, var_slot, 1)
+    var_ring['index'] = (var_slot + 1) % var_size
+    var_ring['count'] = min(var_ring['count'] + 1, var_size)
+    if var_ring['index'] == 0:           # Once per lap, move the origin up and resum so rounding never builds up
+        var_ring['base'] = var_stamp
+        var_ring['sums'] = [0, 0.0, 0.0, 0.0, 0.0]
+        for var_back in range(1, min(var_ring['count'], var_conf_temp_trend) + 1):
+            telemetry_sum(var_ring, (var_ring['index'] - var_back) % var_size, 1)
+
+# Store a temperature message, {heater: {'actual': ..., 'target': ...}, ...}
+def telemetry_add(var_temps):
+    var_printer = printer_ctx()
+    var_stamp = monotonic()
+    with var_printer['telemetry_lock']:
+        for var_heater, var_reading in var_temps.items():
+            if (not isinstance(var_reading, dict)) or (var_reading.get('actual') is None):
+                continue
+            if var_heater not in var_printer['telemetry']:
+                var_printer['telemetry'][var_heater] = telemetry_ring(var_stamp)
+            var_actual, var_target = float(var_reading['actual']), float(var_reading.get('target') or 0.0)
+            telemetry_push(var_printer['telemetry'][var_heater], var_stamp, var_actual, var_target)
+            var_labels = (('printer', var_printer['name']), ('heater', var_heater))
+            metric_set('controlpad_temperature_celsius', var_labels, var_actual)
+            metric_set('controlpad_temperature_target_celsius', var_labels, var_target)
+
+# Record a target just sent, so a second press sees it before the next reading
+def telemetry_target(var_heater, var_target):
+    var_printer = printer_ctx()
+    with var_printer['telemetry_lock']:
+        var_ring = var_printer['telemetry'].get(var_heater)
+        if (var_ring is not None) and (var_ring['count'] > 0):
+            var_ring['target'][(var_ring['index'] - 1) % len(var_ring['time'])] = float(var_target)
+
+# Latest reading of a heater: actual, target, rate (Degrees C per second, None
+# until there are 3 readings), eta (Seconds to target, 0 when ready, None when
+# not heating towards it) and age (Seconds). None without a recent reading.
+def telemetry_read(var_heater):
+    var_printer = printer_ctx()
+    with var_printer['telemetry_lock']:
+        var_ring = var_printer['telemetry'].get(var_heater)
+        if (var_ring is None) or (var_ring['count'] == 0):
+            return None
+        var_slot = (var_ring['index'] - 1) % len(var_ring['time'])
+        var_reading = {'actual': var_ring['actual'][var_slot], 'target': var_ring['target'][var_slot], 'rate': None, 'eta': None, 'age': monotonic() - var_ring['time'][var_slot]}
+        var_n, var_sx, var_sy, var_sxy, var_sxx = var_ring['sums']
+    if var_reading['age'] > var_conf_temp_age:
+        return None
+    var_spread = (var_n * var_sxx) - (var_sx * var_sx)
+    if (var_n >= 3) and (var_spread > 1e-9):
+        var_reading['rate'] = ((var_n * var_sxy) - (var_sx * var_sy)) / var_spread
+    var_remaining = var_reading['target'] - var_reading['actual']
+    if var_reading['target'] > 0:
+        if abs(var_remaining) <= var_conf_temp_band:
+            var_reading['eta'] = 0.0
+        elif (var_reading['rate'] is not None) and (abs(var_reading['rate']) >= 0.05) and (var_remaining * var_reading['rate'] > 0):
+            var_reading['eta'] = var_remaining / var_reading['rate']
+    return var_reading
+
+# Latest reading of a heater, asking OctoPrint only when there is none recent.
+# Asks even while push events are live: OctoPrint sends temperatures only
+# every 5 seconds when idle, so the pushed reading can be just too old.
+def telemetry_fresh(var_heater):
+    var_reading = telemetry_read(var_heater)
+    if var_reading is None:
+        printer_fetch()
+        var_reading = telemetry_read(var_heater)
+    return var_reading
+
+# Whether a heater is still heating up to its target
+def telemetry_heating(var_reading):
+    return (var_reading is not None) and (var_reading['target'] > 0) and (var_reading['target'] - var_reading['actual'] > var_conf_temp_band)
+
+# LED 1 while the hotend heats: pulses, faster as the ETA shrinks
+def telemetry_led(var_heater):
+    var_reading = telemetry_read(var_heater)
+    if not telemetry_heating(var_reading):
+        return ('on',)
+    if (var_reading['eta'] is None) or (var_reading['eta'] > 60):
+        return ('pulse', 1.0)
+    elif var_reading['eta'] > 15:
+        return ('pulse', 2.0)
+    return ('pulse', 4.0)
+
+# Fetch the printer state for the monitor and share it, returns the raw state
+def printer_refresh():
+    if printer_ctx()['event_state'] is not None:
+        return printer_ctx()['event_state']  # events_store() keeps the snapshot current
+    return printer_fetch()
+
+# Ask OctoPrint for the printer state and temperatures, returns the raw state
+def printer_fetch():
+    for var_attempt in range(var_conf_api_retries):
+        var_result = api_request('GET', '/api/printer?exclude=sd')
+        try:
+            if var_result['ok']:
+                var_tool0 = var_result['data']['temperature']['tool0']
+                telemetry_add(var_result['data']['temperature'])
+                var_snapshot = {'state': printer_steady(str(var_result['data']['state']['text']), printer_ctx()['state']), 'target': str(var_tool0['target']), 'actual': str(var_tool0['actual'])}
+                cache_store(var_snapshot)
+                return var_snapshot['state']
+            elif var_result['status'] == 409:    # Printer not operational, only /api/connection knows why
+                var_state = api_pull('/api/connection', ('current', 'state'))
+                if var_state != 'Error':
+                    cache_store({'state': var_state, 'target': 'Error', 'actual': 'Error'})
+                return var_state
+        except (KeyError, TypeError):
+            var_result['error'] = 'unexpected response'
+        log('API', "Error: GET /api/printer, {} (attempt {}/{})".format(var_result['error'], var_attempt + 1, var_conf_api_retries), status=var_result['status'], latency=round(var_result['latency'], 4))
+        if var_attempt + 1 < var_conf_api_retries:
+            metric_inc('controlpad_api_retries_total', (('printer', printer_ctx()['name']), ('path', '/api/printer')))
+            sleep(var_conf_api_retry_delay)
+    return 'Error'
 
 # OctoPrint REST API Pull function
 def printer_pull(var_command, var_input1='none'):
+    var_start = time()
+    var_source = 'cache' if cache_read() is not None else 'api'
+    var_value = printer_pull_value(var_command, var_input1)
+    metric_observe('controlpad_pull_seconds', (('printer', printer_ctx()['name']), ('command', var_command), ('source', var_source)), time() - var_start)
+    return var_value
+
+def printer_pull_value(var_command, var_input1):
+    var_snapshot = cache_read()
     if var_command == 'state':
-        for _ in range(3):
-            try:
-                var_json_string = os.popen (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X GET http://127.0.0.1/api/connection').format(var_api_key)).read()
-                var_json_parsed = json.loads(var_json_string)
-                var_state = str(var_json_parsed['current']['state'])
-                if (var_input1 == 'basic') or (var_input1 == 'none'):
-                    if (var_state == 'Operational') or (var_state == 'Printing') or (var_state == 'Paused'):
-                        return 'Connected'
-                    else:
-                        return 'Disconnected'
-                elif var_input1 == 'detailed':
-                    if (var_state != 'Operational') and (var_state != 'Printing') and (var_state != 'Paused'):
-                        return 'Disconnected'
-                    else:
-                        return var_state
-                elif var_input1 == 'raw':
-                    return var_state
-                else:
-                    print("{} is not a valid verbosity. Please use one of the following: basic, detailed, raw").format(var_input1)
-                    return 'Error'
-            except:
-                sleep(0.5)
-        return 'Error'
+        if var_snapshot is not None:
+            return printer_state(var_snapshot['state'], var_input1)
+        return printer_state(api_pull('/api/connection', ('current', 'state')), var_input1)
     elif var_command == 'target':
-        for _ in range(3):
-            try:
-                var_json_string = os.popen (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X GET http://127.0.0.1/api/printer/tool').format(var_api_key)).read()
-                var_json_parsed = json.loads(var_json_string)
-                var_target = str(var_json_parsed['tool0']['target'])
-                return var_target
-            except:
-               sleep(0.5)
-        return 'Error'
+        if var_snapshot is not None:
+            return var_snapshot['target']
+        return api_pull('/api/printer/tool', ('tool0', 'target'))
     elif var_command == 'job':
-        for _ in range(3):
-            try:
-                var_json_string = os.popen (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X GET http://127.0.0.1/api/job').format(var_api_key)).read()
-                var_json_parsed = json.loads(var_json_string)
-                var_jobstatus = str(var_json_parsed['state'])
-                return var_jobstatus
-            except:
-                sleep(0.5)
-        return 'Error'
+        if var_snapshot is not None:
+            return var_snapshot['state']
+        return api_pull('/api/job', ('state',))
     else:
-        print("{} is not a valid command. Please use one of the following: connection, target, job").format(var_command)
+        log('API', "Error: {} is not a valid command. Please use one of the following: connection, target, job".format(var_command))
+
+# OctoPrint Command Pipelines
+# Multi-step actions as ordered steps: ('gcode', line) or ('api', path, body).
+# printer_pipeline() sends each run of consecutive G-code steps as a single
+# /api/printer/command "commands" request and the API steps back to back over
+# the same keep-alive connection. Every step is sent even if an earlier one
+# failed, as the separate calls always were.
+var_pipelines = {
+    'home': (                # Cool down, home
+        ('gcode', 'M104 S0'),
+        ('gcode', 'G28 X0 Y0 Z0'),
+    ),
+    'pause': (               # Pause, park the printhead
+        ('api', '/api/job', {'command': 'pause', 'action': 'pause'}),
+        ('api', '/api/printer/printhead', {'command': 'jog', 'absolute': 1, 'x': 0, 'y': -60}),
+    ),
+    'abort': (               # Cancel print, cool down, home
+        ('api', '/api/job', {'command': 'cancel'}),
+        ('gcode', 'M104 S0'),
+        ('gcode', 'G28 X0 Y0 Z0'),
+    ),
+}
+
+# Returns ok, error (first failure), latency (Seconds, total) and steps, one
+# result per step with the latency of the request that carried it
+def printer_pipeline(var_steps):
+    var_pipeline = {'ok': True, 'error': None, 'latency': 0.0, 'steps': []}
+    var_start = time()
+    var_index = 0
+    while var_index < len(var_steps):
+        if var_steps[var_index][0] == 'gcode':
+            var_batch = []
+            while (var_index < len(var_steps)) and (var_steps[var_index][0] == 'gcode'):
+                var_batch.append(var_steps[var_index])
+                var_index = var_index + 1
+            var_result = api_push('/api/printer/command', {'commands': [var_step[1] for var_step in var_batch]})
+        else:
+            var_batch = [var_steps[var_index]]
+            var_index = var_index + 1
+            var_result = api_push(var_batch[0][1], var_batch[0][2])
+        for var_step in var_batch:
+            var_pipeline['steps'].append({'step': var_step, 'ok': var_result['ok'], 'error': var_result['error'], 'latency': var_result['latency']})
+        if (not var_result['ok']) and var_pipeline['ok']:
+            var_pipeline['ok'] = False
+            var_pipeline['error'] = var_result['error']
+    var_pipeline['latency'] = time() - var_start
+    return var_pipeline
 
 # OctoPrint REST API Push function
 def printer_push(var_command, var_input1='none', var_input2='none', var_input3='none'):
+    var_start = time()
+    var_result = printer_push_command(var_command, var_input1, var_input2, var_input3)
+    var_labels = (('printer', printer_ctx()['name']), ('command', var_command))
+    metric_observe('controlpad_push_seconds', var_labels, time() - var_start)
+    if (var_result is not None) and (not var_result['ok']):
+        metric_inc('controlpad_push_errors_total', var_labels)
+    return var_result
+
+def printer_push_command(var_command, var_input1, var_input2, var_input3):
     if var_command == 'connect':
-        for _ in range(16):
-            os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {0}" -X POST -d \'{{ "command":"connect" }}\' http://127.0.0.1/api/connection').format(var_api_key))
-            sleep(0.55)
-            var_state = printer_pull('state')
-            if var_state == 'Connected':
-                GPIO.output(var_gpio_led1, GPIO.HIGH)
-                break
-            else:
-                GPIO.output(var_gpio_led1, GPIO.HIGH)
-                sleep(0.5)
-                GPIO.output(var_gpio_led1, GPIO.LOW)
+        return printer_connect()
     elif var_command == 'disconnect':
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {0}" -X POST -d \'{{ "command":"disconnect" }}\' http://127.0.0.1/api/connection').format(var_api_key))
+        return api_push('/api/connection', {'command': 'disconnect'})
     elif var_command == 'cancel':
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {0}" -X POST -d \'{{ "command":"cancel" }}\' http://127.0.0.1/api/job').format(var_api_key))
-    elif var_command == 'home':
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {0}" -X POST -d \'{{ "command":"target", "targets": {{ "tool0":0.0 }} }}\' http://127.0.0.1/api/printer/tool').format(var_api_key))
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {0}" -X POST -d \'{{ "command":"home", "axes":"xyz" }}\' http://127.0.0.1/api/printer/printhead').format(var_api_key))
-    elif var_command == 'pause':
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X POST -d \'{{ "command":"pause","action":"pause" }}\' http://127.0.0.1/api/job').format(var_api_key))
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X POST -d \'{{ "command":"jog","absolute":1,"x":0,"y":-60 }}\' http://127.0.0.1/api/printer/printhead').format(var_api_key))
+        return api_push('/api/job', {'command': 'cancel'})
+    elif (var_command == 'home') and (var_input1 != 'none'):   # Home while the hotend heats to var_input1
+        var_result = printer_pipeline((('gcode', 'M104 S{}'.format(var_input1)), ('gcode', 'G28 X0 Y0 Z0')))
+        if var_result['ok']:
+            telemetry_target('tool0', float(var_input1))
+        return var_result
+    elif var_command in var_pipelines:
+        return printer_pipeline(var_pipelines[var_command])
     elif var_command == 'resume':
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X POST -d \'{{ "command":"pause","action":"resume" }}\' http://127.0.0.1/api/job').format(var_api_key))
+        return api_push('/api/job', {'command': 'pause', 'action': 'resume'})
     elif var_command == 'calibrate':
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X POST -d \'{{ "command":"play /sd/factory_setup.gcode" }}\' http://127.0.0.1/api/printer/command').format(var_api_key))
+        return api_push('/api/printer/command', {'command': 'play /sd/factory_setup.gcode'})
     elif var_command == 'temp':
         if var_input1 != 'none':
-            os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {0}" -X POST -d \'{{ "command":"target", "targets": {{ "tool0":{1} }} }}\' http://127.0.0.1/api/printer/tool').format(var_api_key, var_input1))
+            var_result = api_push('/api/printer/tool', {'command': 'target', 'targets': {'tool0': var_input1}})
+            if var_result['ok']:
+                telemetry_target('tool0', var_input1)
+            return var_result
     elif (var_command == 'extrude') and (var_input1 != 'none'):
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {0}" -X POST -d \'{{ "command":"extrude", "amount":{1} }}\' http://127.0.0.1/api/printer/tool').format(var_api_key, var_input1))
+        return api_push('/api/printer/tool', {'command': 'extrude', 'amount': var_input1})
     elif (var_command == 'rgb') and (var_input1 != 'none') and (var_input2 != 'none') and (var_input3 != 'none'):
-        os.system (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {0}" -X POST -d \'{{ "command":"M150 R{1} U{2} B{3}" }}\' http://127.0.0.1/api/printer/command').format(var_api_key, var_input1, var_input2, var_input3))
+        return api_push('/api/printer/command', {'command': 'M150 R{} U{} B{}'.format(var_input1, var_input2, var_input3)})
     else:
-        print("{} is not a valid command. Please use one of the following: connect, disconnect, cancel, home, temp, extrude, rgb").format(var_command)
+        log('API', "Error: {} is not a valid command. Please use one of the following: connect, disconnect, cancel, home, pause, abort, resume, calibrate, temp, extrude, rgb".format(var_command))
 
-# Wait for OctoPrint to load
-def conwait():
-    print("Connecting to OctoPrint...")
+# Printer Connection
+# printer_push('connect') sends one connect request per attempt and then waits
+# for the printer to become Operational: on the push events while the stream is
+# live, otherwise polling /api/connection every var_conf_connect_poll seconds,
+# doubling up to 1 second. Right after Relay 1 switches on, the printer's board
+# is still booting and its serial port missing, so each attempt first polls the
+# same way, for up to var_conf_connect_port_wait, until OctoPrint lists a port
+# and connects the moment one appears. The printer then has
+# var_conf_connect_timeout from the connect request to become Operational. An
+# attempt that errors or times out is retried, up to var_conf_connect_attempts,
+# except that one timing out while OctoPrint is still connecting leaves the
+# next attempt waiting on the same request, as a second connect would restart
+# it. Each attempt logs and records its time to Operational.
+def printer_connect():
+    var_printer = printer_ctx()
+    var_labels = (('printer', var_printer['name']),)
+    led_set(var_printer['gpio_led1'], 'blink', 1.0)
+    var_pending = False
+    for var_attempt in range(1, var_conf_connect_attempts + 1):
+        var_start = time()
+        if not var_pending:
+            connect_port(var_start + var_conf_connect_port_wait)
+            var_result = api_push('/api/connection', {'command': 'connect'})
+            var_sent = time()
+        if var_result['ok']:
+            var_state, var_last = connect_ready(var_sent, time() + var_conf_connect_timeout)
+        else:
+            var_state, var_last = var_result['error'], None
+        var_pending = (var_state is None) and connect_transitional(var_last)
+        var_outcome = 'ok' if var_state == 'Operational' else ('timeout' if var_state is None else 'failed')
+        metric_observe('controlpad_connect_seconds', var_labels + (('attempt', var_attempt), ('result', var_outcome)), time() - var_start)
+        if var_outcome == 'ok':
+            log('API', "Printer operational after {:.1f}s (attempt {}/{})".format(time() - var_start, var_attempt, var_conf_connect_attempts), action='connect_ok', latency=round(time() - var_start, 3))
+            led_set(var_printer['gpio_led1'], 'on')
+            return var_result
+        log('API', "Error: Connect attempt {}/{} {} after {:.1f}s{}".format(var_attempt, var_conf_connect_attempts, 'timed out' if var_state is None else 'failed ({})'.format(var_state), time() - var_start, ', still {}'.format(var_last) if var_pending else ''), action='connect_' + var_outcome, latency=round(time() - var_start, 3))
+        if var_stop.is_set():
+            break
+    led_set(var_printer['gpio_led1'], 'off')
+    return dict(var_result, ok=False, error='not operational')
+
+# OctoPrint states while it opens the port and detects the printer
+def connect_transitional(var_state):
+    return (var_state is not None) and var_state.startswith(('Opening', 'Detecting', 'Connecting'))
+
+# Raw connection state and OctoPrint's serial port list (None when it has
+# none), state None when OctoPrint did not answer
+def connect_status():
+    var_result = api_request('GET', '/api/connection')
+    try:
+        if var_result['ok']:
+            return str(var_result['data']['current']['state']), var_result['data'].get('options', {}).get('ports')
+    except (KeyError, TypeError, AttributeError):
+        pass
+    return None, None
+
+# Wait until OctoPrint lists a serial port, or var_deadline. OctoPrint versions
+# without a port list connect right away.
+def connect_port(var_deadline):
+    var_wait = var_conf_connect_poll
+    while not var_stop.is_set():
+        var_state, var_ports = connect_status()
+        if ((var_state is not None) and (var_ports is None)) or var_ports or (time() + var_wait > var_deadline):
+            return
+        watchdog_beat(var_wait)
+        var_stop.wait(var_wait)
+        var_wait = min(var_wait * 2, 1.0)
+
+# Wait for the connection to settle, var_sent is when the connect request went
+# out. Returns the raw state once Operational or failed, or None at
+# var_deadline, and the last state seen. Closed or Offline only count as failed
+# once OctoPrint had 3 seconds to start connecting (push events may lag behind).
+def connect_ready(var_sent, var_deadline):
+    var_printer = printer_ctx()
+    var_wait = var_conf_connect_poll
+    var_last = None
+    while not var_stop.is_set():
+        var_printer['event_signal'].clear()
+        var_state = var_printer['event_state']
+        if var_state is None:
+            var_state = connect_status()[0]
+        if var_state is not None:
+            var_last = var_state
+            if (var_state == 'Operational') or ('error' in var_state.lower()):
+                return var_state, var_last
+            if (var_state in ('Closed', 'Offline')) and (time() - var_sent > 3.0):
+                return var_state, var_last
+        var_remaining = var_deadline - time()
+        if var_remaining <= 0:
+            return None, var_last
+        if var_printer['event_state'] is not None:
+            watchdog_beat(1.0)
+            var_printer['event_signal'].wait(min(var_remaining, 1.0))
+        else:
+            watchdog_beat(var_wait)
+            var_stop.wait(min(var_remaining, var_wait))
+            var_wait = min(var_wait * 2, 1.0)
+    return None, var_last
+
+# OctoPrint Push Event Subscriber
+# Follows the SockJS xhr_streaming transport on its own HTTP/1.0 connection, so
+# the stream is plain newline-delimited frames. While the stream is live the
+# monitor reads the printer's event_state (latest raw state from the stream,
+# None while the stream is down) instead of polling /api/connection.
+# event_tool0 holds the latest tool0 temperatures and event_changed when the
+# stream last reported a different state.
+var_event_types = {          # Push event type -> raw printer state
+    'Connected': 'Operational',
+    'Disconnected': 'Closed',
+    'PrintStarted': 'Printing',
+    'PrintResumed': 'Printing',
+    'PrintPaused': 'Paused',
+    'PrintDone': 'Operational',
+    'PrintFailed': 'Operational',
+    'PrintCancelled': 'Operational',
+}
+var_event_outcomes = {       # Push event type -> print outcome, see stats_add()
+    'PrintDone': 'done',
+    'PrintFailed': 'failed',
+    'PrintCancelled': 'cancelled',
+}
+
+def events_set_state(var_state):
+    var_printer = printer_ctx()
+    if var_state != var_printer['event_state']:
+        var_printer['event_state'] = var_state
+        var_printer['event_changed'] = time()
+        var_printer['wake'].set()
+        var_printer['event_signal'].set()
+    events_store()
+
+def events_store():
+    var_printer = printer_ctx()
+    var_snapshot = {'state': var_printer['event_state'], 'target': 'Error', 'actual': 'Error'}
+    if (printer_state(var_printer['event_state']) == 'Connected') and (var_printer['event_tool0'] is not None):
+        var_snapshot['target'] = str(var_printer['event_tool0']['target'])
+        var_snapshot['actual'] = str(var_printer['event_tool0']['actual'])
+    cache_store(var_snapshot)
+
+def events_handle(var_message):
+    if 'current' in var_message:
+        try:
+            if var_message['current'].get('temps'):
+                printer_ctx()['event_tool0'] = var_message['current']['temps'][-1]['tool0']
+                telemetry_add(var_message['current']['temps'][-1])
+            events_set_state(printer_steady(str(var_message['current']['state']['text']), printer_ctx()['event_state'] or printer_ctx()['state']))
+        except (KeyError, TypeError):
+            pass
+    elif 'event' in var_message:
+        var_type = var_message['event'].get('type')
+        if var_type == 'PrintStarted':
+            printer_ctx()['event_started'] = True
+        if var_type in var_event_types:
+            events_set_state(var_event_types[var_type])
+        if var_type in var_event_outcomes:
+            stats_add('job', var_event_outcomes[var_type])
+
+def events_stream():
+    var_login = api_request('POST', '/api/login', {'passive': True})
+    if not var_login['ok']:
+        log('Events', "Error: Login failed ({})".format(var_login['error']))
+        return False
+    var_auth = '{}:{}'.format(var_login['data']['name'], var_login['data']['session'])
+    var_path = '/sockjs/{:03d}/{:08x}'.format(random.randint(0, 999), random.getrandbits(32))
+    var_received = False
     while True:
-        GPIO.output(var_gpio_led0, GPIO.HIGH)
+        conn = httplib.HTTPConnection(printer_ctx()['api_host'], printer_ctx()['api_port'], timeout=var_conf_events_timeout)
+        conn._http_vsn = 10          # HTTP/1.0: no chunked encoding, the body ends when the server closes
+        conn._http_vsn_str = 'HTTP/1.0'
+        try:
+            conn.request('POST', var_path + '/xhr_streaming')
+            response = conn.getresponse()
+            if response.status != 200:
+                log('Events', "Error: HTTP {}".format(response.status))
+                return var_received
+            var_lines = 0
+            while True:
+                watchdog_beat(var_conf_events_timeout)
+                var_line = response.fp.readline().decode('utf-8').strip()
+                if not var_line:
+                    break            # Server ends each response after a byte limit, poll the same session again
+                var_lines = var_lines + 1
+                if var_line == 'o':
+                    api_push(var_path + '/xhr_send', [json.dumps({'auth': var_auth})])
+                elif var_line[0] == 'a':
+                    var_received = True
+                    for var_frame in json.loads(var_line[1:]):
+                        if not isinstance(var_frame, dict):
+                            var_frame = json.loads(var_frame)
+                        events_handle(var_frame)
+                elif var_line[0] == 'c':
+                    return var_received
+            if var_lines == 0:
+                return var_received
+        finally:
+            conn.close()
+
+def events_loop(var_printer):
+    printer_bind(var_printer)
+    var_backoff = 1
+    while not var_stop.is_set():
         try:
-            var_json_string = os.popen (('curl -s -H "Content-Type: application/json" -H "X-Api-Key: {}" -X GET http://127.0.0.1/api/connection').format(var_api_key)).read()
-            var_json_parsed = json.loads(var_json_string)
-            var_state = str(var_json_parsed['current']['state'])
-        except:
+            if events_stream():
+                var_backoff = 1
+        except (httplib.HTTPException, socket.error, ValueError, KeyError, TypeError, AttributeError) as e:
+            log('Events', "Error: {}".format(e))
+        if var_printer['event_state'] is not None:
+            log('Events', "Push stream lost, falling back to polling")
+            var_printer['event_state'] = None
+            var_printer['event_tool0'] = None
+            var_printer['wake'].set()
+        watchdog_beat(var_backoff)
+        var_stop.wait(var_backoff)
+        var_backoff = min(var_backoff * 2, 30)
+
+# Startup
+# Buttons and LEDs go live before OctoPrint answers: the monitor task waits for
+# OctoPrint in conwait() while loop() already takes input. Until the printer's
+# ready event is set, only the actions in var_panel_offline run, and a printer
+# powered on in the meantime (ready_connect holds the button) is connected once
+# OctoPrint is up.
+
+# Log how long a startup phase took since the script started
+def startup_report(var_phase, var_message):
+    var_elapsed = time() - var_started
+    var_uptime = None
+    try:
+        with open('/proc/uptime') as stream:
+            var_uptime = float(stream.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    var_labels = (('phase', var_phase),)
+    if getattr(var_printer_local, 'printer', None) is not None:
+        var_labels = (('printer', printer_ctx()['name']),) + var_labels
+    metric_set('controlpad_startup_seconds', var_labels, var_elapsed)
+    log('Startup', "{} after {:.0f}ms{}".format(var_message, var_elapsed * 1000, '' if var_uptime is None else ', {:.1f}s after boot'.format(var_uptime)), action=var_phase, latency=round(var_elapsed, 4), uptime=var_uptime)
+
+# Wait for OctoPrint to load, returns False if stopped first
+def conwait():
+    var_printer = printer_ctx()
+    var_gpio_led0, var_gpio_led1 = var_printer['gpio_led0'], var_printer['gpio_led1']
+    log('Startup', "Connecting to OctoPrint at {}:{}...".format(var_printer['api_host'], var_printer['api_port']))
+    led_set(var_gpio_led0, 'blink', 3.0)
+    var_failures = 0
+    var_start = time()
+    var_late = False
+    while not var_stop.is_set():
+        var_result = api_request('GET', '/api/connection', var_timeout=0.5)
+        try:
+            var_state = str(var_result['data']['current']['state'])
+        except (KeyError, TypeError):
             var_state = 'none'
         if (var_state == 'Closed') or (var_state == 'Operational') or ('Failed' in var_state):
-            print("Connection established")
+            startup_report('octoprint', "Connection established")
+            var_printer['ready'].set()
+            led_set(var_gpio_led0, 'on')
             sleep(0.2)
-            GPIO.output(var_gpio_led1, GPIO.HIGH)
+            led_set(var_gpio_led1, 'on')
             sleep(0.5)
             beep('up')
             sleep(0.2)
-            GPIO.output(var_gpio_led1, GPIO.LOW)
-            GPIO.output(var_gpio_led0, GPIO.LOW)
+            led_set(var_gpio_led1, 'off')
+            led_set(var_gpio_led0, 'off')
+            return True
+        var_failures = var_failures + 1
+        if (not var_late) and (time() - var_start >= var_conf_api_ready):
+            var_late = True
+            log('Startup', "Error: OctoPrint not answering after {}s ({}), still trying".format(var_conf_api_ready, var_result['error']))
+            beep('error')
+        var_wait = poll_backoff(var_failures)
+        watchdog_beat(var_wait)
+        var_stop.wait(var_wait)
+    return False
+
+# Poll Scheduler
+# Picks how long the monitor sleeps before its next pass: fast for a while after
+# a state change or button press, slower while printing, slowest while idle or
+# powered-off, and exponential backoff with jitter while OctoPrint can't be
+# reached. A button press wakes the monitor at once through poll_boost(). Each
+# printer keeps its own schedule in its poll dict.
+def poll_boost(var_wake=True, var_printer=None):
+    if var_printer is None:
+        var_printer = printer_ctx()
+    var_printer['poll']['boost'] = time() + var_conf_poll_boost
+    if var_wake:
+        var_printer['wake'].set()
+    control_notify()
+
+def poll_backoff(var_failures):
+    var_interval = min(var_conf_poll_fast * (2 ** min(var_failures, 16)), var_conf_poll_backoff)  # Exponent capped, 2 ** 1024 overflows a float
+    return random.uniform(var_interval / 2, var_interval)
+
+def poll_interval(var_powered, var_state):
+    var_poll = printer_ctx()['poll']
+    if var_powered and (var_state == 'Error'):
+        var_poll['failures'] = min(var_poll['failures'] + 1, 16)
+        var_reason, var_interval = 'unreachable', poll_backoff(var_poll['failures'])
+    else:
+        var_poll['failures'] = 0
+        if time() < var_poll['boost']:
+            var_reason, var_interval = 'fast', var_conf_poll_fast
+        elif not var_powered:
+            var_reason, var_interval = 'powered-off', var_conf_poll_idle
+        elif var_state in ('Printing', 'Paused'):
+            var_reason, var_interval = 'busy', var_conf_poll_busy
+        elif (var_state == 'Operational') and telemetry_heating(telemetry_read('tool0')):
+            var_reason, var_interval = 'heating', var_conf_poll_busy
+        else:
+            var_reason, var_interval = 'idle', var_conf_poll_idle
+    var_labels = (('printer', printer_ctx()['name']),)
+    if var_reason != var_poll['reason']:
+        log('Monitor', "Poll interval {:.2f}s ({}), {} API requests sent".format(var_interval, var_reason, metric_total('controlpad_api_request_seconds')), action='poll_' + var_reason.replace('-', '_'))
+        metric_set('controlpad_poll_interval_seconds', var_labels + (('reason', var_poll['reason']),), 0)
+    metric_set('controlpad_poll_interval_seconds', var_labels + (('reason', var_reason),), var_interval)
+    var_changed = (var_reason != var_poll['reason'])
+    var_poll['reason'] = var_reason
+    var_poll['interval'] = var_interval
+    if var_changed:
+        control_notify()
+    return var_interval
+
+# Filament Sensor
+# The sensor reads HIGH once the filament has run out. Its edge callback only
+# wakes the printer's filament_loop(), which samples the pin
+# var_conf_runout_window times per var_conf_runout_debounce into a sliding
+# window, sliding on while edges keep arriving (for up to three debounce
+# times), and takes the majority of the window as the sensor level. A changed
+# level is a confirmed runout or reload, an edge that changes nothing counts as
+# a glitch. A confirmed runout while printing pauses the print.
+var_filament_owner = {}      # Sensor GPIO -> printer
+
+def filament_edge(var_gpio):
+    var_printer = var_filament_owner[var_gpio]
+    if not var_printer['runout_edge'].is_set():
+        var_printer['runout_edge_time'] = time()
+    var_printer['runout_edge'].set()
+
+# Fill var_window until it holds a full window taken after the last edge
+def filament_sample(var_printer, var_window):
+    var_interval = var_conf_runout_debounce / var_conf_runout_window
+    var_quiet = 0
+    for _ in range(var_conf_runout_window * 3):
+        if var_stop.wait(var_interval):
+            return
+        if var_printer['runout_edge'].is_set():
+            var_printer['runout_edge'].clear()
+            var_quiet = 0
+        var_window.append(GPIO.input(var_printer['gpio_sen0']) == GPIO.HIGH)
+        var_quiet = var_quiet + 1
+        if var_quiet >= var_conf_runout_window:
+            return
+
+def filament_runout(var_edge_time):
+    var_printer = printer_ctx()
+    var_gpio = var_printer['gpio_sen0']
+    beep('error')
+    if (GPIO.input(var_printer['gpio_rly1']) == False) and var_printer['ready'].is_set() and (var_printer['runout_pause'] == 1):
+        if printer_pull('job') == 'Printing':
+            log('Filament', "Filament runout, pausing print", pin=var_gpio, action='runout_pause')
+            printer_push('pause')
+            metric_observe('controlpad_filament_pause_seconds', (('printer', var_printer['name']),), time() - var_edge_time)
+            return
+    log('Filament', "Filament runout", pin=var_gpio, action='runout')
+
+# Filament Task
+# One per printer
+def filament_loop(var_printer):
+    printer_bind(var_printer)
+    var_gpio = var_printer['gpio_sen0']
+    var_labels = (('printer', var_printer['name']),)
+    var_window = deque([GPIO.input(var_gpio) == GPIO.HIGH] * var_conf_runout_window, maxlen=var_conf_runout_window)
+    var_printer['runout'] = var_window[-1]
+    metric_set('controlpad_filament_runout', var_labels, int(var_printer['runout']))
+    if var_printer['runout']:
+        log('Filament', "No filament loaded", pin=var_gpio, action='runout')
+    while not var_stop.is_set():
+        watchdog_beat(var_conf_runout_recheck)
+        if not var_printer['runout_edge'].wait(var_conf_runout_recheck):
+            if (GPIO.input(var_gpio) == GPIO.HIGH) == var_printer['runout']:
+                continue
+            var_printer['runout_edge_time'] = time()   # Edge missed by the backend
+        if var_stop.is_set():
             return
+        var_edge_time = var_printer['runout_edge_time']
+        var_printer['runout_edge'].clear()
+        filament_sample(var_printer, var_window)
+        var_runout = (sum(var_window) * 2 > len(var_window))
+        if var_runout == var_printer['runout']:
+            metric_inc('controlpad_filament_glitches_total', var_labels)
+            continue
+        var_printer['runout'] = var_runout
+        metric_set('controlpad_filament_runout', var_labels, int(var_runout))
+        poll_boost(True)                                 # LED 2 follows via the monitor
+        if var_runout:
+            metric_inc('controlpad_filament_runouts_total', var_labels)
+            filament_runout(var_edge_time)
         else:
-            sleep(0.2)
-            GPIO.output(var_gpio_led0, GPIO.LOW)
-            sleep(0.15)
+            log('Filament', "Filament loaded", pin=var_gpio, action='loaded')
+
+# Automatic Shutdown
+# Started by the monitor when a print ends and run on its own thread, so the
+# monitor keeps watching the printer (and its LEDs and telemetry stay live)
+# throughout. The heaters go off at once, then:
+#   countdown  shutdown_time seconds of beeps with LED 1 counting down
+#   cooling    both relays stay on (the printer's own hotend fan included) until
+#              the hotend is below shutdown_temp, or var_conf_shutdown_cooldown
+#              has passed. Reads the monitor's temperature telemetry, sleeping
+#              as long as the cooling rate predicts, so it sends no requests of
+#              its own while the monitor polls or push events arrive
+#   off        disconnect, Relay 1 and Relay 2 off
+# Any button of the printer, or an action sent to the control socket, aborts
+# it until it is off (that press or action does nothing else), as does the
+# printer starting or resuming a print.
+def shutdown_start(var_printer):
+    if var_printer['shutdown'] is not None:
+        return
+    var_printer['shutdown_abort'].clear()
+    var_printer['shutdown'] = 'countdown'
+    thread_start(task, 'shutdown ' + var_printer['name'], shutdown_run, var_printer)
+
+def shutdown_abort(var_printer, var_reason, var_gpio=None):
+    if var_printer['shutdown'] not in ('countdown', 'cooling') or var_printer['shutdown_abort'].is_set():
+        return False
+    var_printer['shutdown_abort'].set()
+    log('Shutdown', "Automatic shutdown aborted ({})".format(var_reason), pin=var_gpio, action='shutdown_aborted', printer=var_printer['name'])
+    return True
+
+# Waits var_seconds, True once aborted or stopping
+def shutdown_wait(var_printer, var_seconds):
+    watchdog_beat(var_seconds)
+    return var_printer['shutdown_abort'].wait(var_seconds) or var_stop.is_set()
+
+# Seconds until the hotend is predicted to be below shutdown_temp, None when cool
+def shutdown_cooling(var_printer):
+    var_reading = telemetry_fresh('tool0')
+    if var_reading is None:
+        return var_conf_poll_idle                    # OctoPrint not answering, try again
+    if var_reading['actual'] < var_printer['shutdown_temp']:
+        return None
+    var_wait = var_conf_poll_idle
+    if (var_reading['rate'] is not None) and (var_reading['rate'] < -0.01):
+        var_wait = (var_reading['actual'] - var_printer['shutdown_temp']) / -var_reading['rate']
+    return min(max(var_wait, var_conf_poll_idle), 30.0)
+
+def shutdown_run(var_printer):
+    printer_bind(var_printer)
+    var_gpio_led1 = var_printer['gpio_led1']
+    var_labels = (('printer', var_printer['name']),)
+    var_result = 'aborted'
+    try:
+        printer_push('temp', 0.0)
+        led_set(var_gpio_led1, 'countdown', 1.0, var_printer['shutdown_time'])
+        for _ in range(var_printer['shutdown_time']):
+            beep()
+            if shutdown_wait(var_printer, 1.0):
+                return
+        var_printer['shutdown'] = 'cooling'
+        led_set(var_gpio_led1, 'blink', 0.5)
+        var_start = time()
+        var_wait = shutdown_cooling(var_printer)
+        if var_wait is not None:
+            log('Shutdown', "Waiting for the hotend to cool below {:.0f}C".format(var_printer['shutdown_temp']), pin=var_gpio_led1, action='shutdown_cooling')
+        var_result = 'off'
+        while var_wait is not None:
+            if time() - var_start > var_conf_shutdown_cooldown:
+                log('Shutdown', "Error: Hotend still above {:.0f}C after {}s, powering off anyway".format(var_printer['shutdown_temp'], var_conf_shutdown_cooldown), pin=var_gpio_led1, action='shutdown_timeout')
+                var_result = 'timeout'
+                break
+            if shutdown_wait(var_printer, var_wait):
+                var_result = 'aborted'
+                return
+            var_wait = shutdown_cooling(var_printer)
+        if shutdown_wait(var_printer, 0):
+            var_result = 'aborted'
+            return
+        var_printer['shutdown'] = 'off'
+        log('Shutdown', "Disconnecting from Printer, Relay 1 OFF, Relay 2 OFF", pin=var_gpio_led1, action='shutdown_off', latency=round(time() - var_start, 1))
+        beep()
+        printer_push('disconnect')
+        sleep(0.25)
+        GPIO.output(var_printer['gpio_rly1'], GPIO.HIGH)
+        GPIO.output(var_printer['gpio_rly2'], GPIO.HIGH)
+        state_save()
+    finally:
+        var_printer['shutdown'] = None
+        if not var_stop.is_set():
+            metric_inc('controlpad_shutdowns_total', var_labels + (('result', var_result),))
+            if var_result == 'aborted':
+                led_set(var_gpio_led1, 'on')
+                beep('up')
+            poll_boost(True, var_printer)
 
-# Monitoring Process
-def loop_monitor():
+# Monitoring Task
+# One per printer, reading that printer's GPIOs and policy
+def loop_monitor(var_printer):
+    printer_bind(var_printer)
+    var_gpio_rly1 = var_printer['gpio_rly1']
+    var_gpio_led0, var_gpio_led1, var_gpio_led2 = var_printer['gpio_led0'], var_printer['gpio_led1'], var_printer['gpio_led2']
+    var_conf_shutdown_auto = var_printer['shutdown_auto']
+    var_labels = (('printer', var_printer['name']),)
     var_state = 'none'
     var_state_previous = 'none'
     output_value = 'none'
     output_value_previous = GPIO.input(var_gpio_rly1)
 
-    while True:
+    if (not var_printer['ready'].is_set()) and (not conwait()):
+        return
+    for var_gpio in var_printer['ready_connect'][:1]:
+        if GPIO.input(var_gpio_rly1) == False:
+            thread_start(printer_run, var_printer, action_connect, var_gpio, 0)
+    del var_printer['ready_connect'][:]
+    if var_printer['resume'] is not None:
+        led_set(var_gpio_led0, 'on')                 # Relay 1 was restored on, no transition to show it
+        var_state_previous = var_printer['state']
+        var_printer['resume'] = None
+    var_pass = time()
+
+    if (var_conf_events == 1) and (var_printer['events'] is None):  # A restarted monitor keeps the running subscriber
+        var_printer['events'] = thread_start(task, 'events ' + var_printer['name'], events_loop, var_printer)
+
+    while not var_stop.is_set():
+        var_printer['wake'].clear()
+        var_pass_previous, var_pass = var_pass, time()
+
         # LED 0 - Printer Power Status
         output_value = GPIO.input(var_gpio_rly1)
         if output_value != output_value_previous:
+            poll_boost(False)
             if output_value == False:
-                GPIO.output(var_gpio_led0, GPIO.HIGH)
+                led_set(var_gpio_led0, 'on')
                 beep()
-                print("Monitor, GPIO {1}, Relay 1 (GPIO {0}) ON").format(var_gpio_rly1, var_gpio_led0)
+                log('Monitor', "Relay 1 (GPIO {}) ON".format(var_gpio_rly1), pin=var_gpio_led0, action='relay_on')
                 var_state_previous = 'none'
             else:
-                GPIO.output(var_gpio_led0, GPIO.LOW)
-                GPIO.output(var_gpio_led1, GPIO.LOW)
-                GPIO.output(var_gpio_led2, GPIO.LOW)
+                led_set(var_gpio_led0, 'off')
+                led_set(var_gpio_led1, 'off')
+                led_set(var_gpio_led2, 'off')
                 beep('down')
-                print("Monitor, GPIO {1}, Relay 1 (GPIO {0}) OFF").format(var_gpio_rly1, var_gpio_led0)
+                log('Monitor', "Relay 1 (GPIO {}) OFF".format(var_gpio_rly1), pin=var_gpio_led0, action='relay_off')
         output_value_previous = output_value
+        metric_set('controlpad_relay_on', var_labels, 1 if output_value == False else 0)
+        if output_value == False:
+            metric_inc('controlpad_relay_on_seconds_total', var_labels, var_pass - var_pass_previous)
+            stats_add('power', 'printer', var_pass - var_pass_previous)
+        if GPIO.input(var_printer['gpio_rly2']) == False:
+            stats_add('power', 'fan', var_pass - var_pass_previous)
 
         # LED 1 - Printer Connection Status
         # LED 2 - Paused Status
         if output_value == False:
-            var_state = printer_pull('state', 'detailed')
+            var_seen = time()
+            var_state = printer_state(printer_refresh(), 'detailed')
+            var_started = var_printer['event_started']
+            var_printer['event_started'] = False
+            if (var_state in ('Operational', 'Printing', 'Paused')) and (var_printer['shutdown'] is None):
+                led_set(var_gpio_led1, *telemetry_led('tool0'))
             if var_state != var_state_previous:
+                poll_boost(False)
+                if var_printer['event_state'] is not None:
+                    var_seen = var_printer['event_changed']
+                metric_observe('controlpad_state_change_seconds', var_labels + (('state', var_state),), time() - var_seen)
+                if var_state in ('Printing', 'Paused'):
+                    shutdown_abort(var_printer, 'printer ' + var_state)
                 if (var_state == 'Operational') and (var_state_previous in ('Printing', 'Paused')) and (var_conf_shutdown_auto == 1):
-                    GPIO.output(var_gpio_led1, GPIO.HIGH)
-                    GPIO.output(var_gpio_led2, GPIO.LOW)
+                    led_set(var_gpio_led1, 'on')
+                    led_set(var_gpio_led2, 'off')
                     beep('up')
-                    sleep(0.5)
-                    print("Monitor, GPIO {0}, Print completed or canceled. Automated shutdown initiated, {1} second delay...").format(var_gpio_led1, var_conf_shutdown_time)
-                    printer_push('temp', 0.0)
-                    printer_push('disconnect')
-                    var_state_previous = 'Disconnected'
-                    for _ in range(var_conf_shutdown_time):
-                        GPIO.output(var_gpio_led1, GPIO.LOW)
-                        beep()
-                        sleep(0.5)
-                        GPIO.output(var_gpio_led1, GPIO.HIGH)
-                        sleep(0.5)
-                    GPIO.output(var_gpio_led1, GPIO.LOW)
-                    beep()
-                    sleep(0.25)
-                    GPIO.output(var_gpio_rly1, GPIO.HIGH)
-                    GPIO.output(var_gpio_rly2, GPIO.HIGH)
-                    sleep(0.25)
+                    stats_add('print', 'ended')
+                    log('Monitor', "Print completed or canceled. Automated shutdown in {} seconds, any button aborts".format(var_printer['shutdown_time']), pin=var_gpio_led1, action='auto_shutdown', state_from=var_state_previous, state_to=var_state)
+                    shutdown_start(var_printer)
                 elif (var_state == 'Operational'):
-                    GPIO.output(var_gpio_led1, GPIO.HIGH)
-                    GPIO.output(var_gpio_led2, GPIO.LOW)
+                    if var_state_previous in ('Printing', 'Paused'):
+                        stats_add('print', 'ended')
+                    led_set(var_gpio_led1, 'on')
+                    led_set(var_gpio_led2, 'off')
                     beep('up')
-                    print("Monitor, GPIO {}, Printer connected to OctoPrint").format(var_gpio_led1)
+                    log('Monitor', "Printer connected to OctoPrint", pin=var_gpio_led1, action='connected', state_from=var_state_previous, state_to=var_state)
 
                 if (var_state == 'Paused'):
-                    GPIO.output(var_gpio_led1, GPIO.HIGH)
-                    GPIO.output(var_gpio_led2, GPIO.HIGH)
+                    led_set(var_gpio_led1, 'on')
+                    led_set(var_gpio_led2, 'on')
                     beep('down')
-                    print("Monitor, GPIO {}, Paused print").format(var_gpio_led2)
+                    stats_add('print', 'paused')
+                    log('Monitor', "Paused print", pin=var_gpio_led2, action='paused', state_from=var_state_previous, state_to=var_state)
 
                 if (var_state == 'Printing') and (var_state_previous == 'Paused'):
-                    GPIO.output(var_gpio_led1, GPIO.HIGH)
-                    GPIO.output(var_gpio_led2, GPIO.LOW)
+                    led_set(var_gpio_led1, 'on')
+                    led_set(var_gpio_led2, 'off')
                     beep('up')
-                    print("Monitor, GPIO {}, Resumed print").format(var_gpio_led2)
-                elif (var_state == 'Printing'):
-                    GPIO.output(var_gpio_led1, GPIO.HIGH)
-                    GPIO.output(var_gpio_led2, GPIO.LOW)
+                    stats_add('print', 'resumed')
+                    log('Monitor', "Resumed print", pin=var_gpio_led2, action='resumed', state_from=var_state_previous, state_to=var_state)
+                elif (var_state == 'Printing') and ((var_state_previous == 'Operational') or var_started):
+                    led_set(var_gpio_led1, 'on')
+                    led_set(var_gpio_led2, 'off')
                     beep('up')
-                    print("Monitor, GPIO {}, Started Print").format(var_gpio_led2)
+                    stats_add('print', 'started')
+                    log('Monitor', "Started Print", pin=var_gpio_led2, action='started', state_from=var_state_previous, state_to=var_state)
+                elif (var_state == 'Printing'):                   # Back from a failed read mid-print, not a new print
+                    led_set(var_gpio_led1, 'on')
+                    led_set(var_gpio_led2, 'off')
+                    log('Monitor', "Printing", pin=var_gpio_led2, action='printing', state_from=var_state_previous, state_to=var_state)
 
                 if (var_state == 'Disconnected') and ((var_state_previous == 'Operational') or (var_state_previous == 'Paused') or (var_state_previous == 'Printing')):
-                    GPIO.output(var_gpio_led1, GPIO.LOW)
-                    GPIO.output(var_gpio_led2, GPIO.LOW)
+                    led_set(var_gpio_led1, 'off')
+                    led_set(var_gpio_led2, 'off')
                     beep()
-                    print("Monitor, GPIO {}, Printer disconnected from OctoPrint").format(var_gpio_led1)
+                    log('Monitor', "Printer disconnected from OctoPrint", pin=var_gpio_led1, action='disconnected', state_from=var_state_previous, state_to=var_state)
                 elif (var_state == 'Disconnected'):
-                    GPIO.output(var_gpio_led1, GPIO.LOW)
-                    GPIO.output(var_gpio_led2, GPIO.LOW)
-                    print("Monitor, GPIO {}, Printer not connected to OctoPrint").format(var_gpio_led1)
-            sensor_value = GPIO.input(var_gpio_sen0)
-            if (var_state == 'Paused') or (sensor_value == True):
-                GPIO.output(var_gpio_led2, GPIO.LOW)
-                sleep(0.5)
-                GPIO.output(var_gpio_led2, GPIO.HIGH)
-            if (sensor_value == False):
-                sleep(0.5)
-                GPIO.output(var_gpio_led2, GPIO.LOW)
+                    led_set(var_gpio_led1, 'off')
+                    led_set(var_gpio_led2, 'off')
+                    log('Monitor', "Printer not connected to OctoPrint", pin=var_gpio_led1, action='not_connected', state_from=var_state_previous, state_to=var_state)
+            if (var_state == 'Paused') or var_printer['runout']:
+                led_set(var_gpio_led2, 'blink', 1.0)
+            else:
+                led_set(var_gpio_led2, 'off')
 
             var_state_previous = var_state
 
-        sleep(0.25)
+        var_printer['state'] = var_state if output_value == False else 'none'
+        state_save()
+        metric_observe('controlpad_monitor_loop_seconds', var_labels, time() - var_pass)
+        var_interval = poll_interval(output_value == False, var_state)
+        watchdog_beat(var_interval)
+        var_printer['wake'].wait(var_interval)   # Returns early on a push event or button press
 
-# Main Process
-def loop():
-    var_target = 'none'
-    var_jobstatus = 'none'
+# Button Input
+# Edge callbacks only timestamp level changes into var_button_edges. loop()
+# debounces and classifies them into gestures from those timestamps and hands
+# the gestures to the owning printer's button_worker() through its actions
+# queue, so a slow action (e.g. connecting) never blocks input and no press is
+# dropped. What each gesture does comes from the panel layout, see panel_load().
+var_button_edges = Queue()
+var_button_dispatch = {}     # (GPIO, gesture) or (chord GPIOs, 'chord') -> (printer, action function)
+var_button_owner = {}        # GPIO or chord GPIOs -> printer
+var_button_hold = {}         # Buttons with a long-press action -> hold repeat interval (Seconds), 0 fires once
+var_button_chords = {}       # GPIO -> chords (sorted GPIO tuples) it is part of
+var_buttons = ()
+var_rgb_colors = (           # LED Lighting Selection, one step per hold repeat
+    (000, 000, 000),         # Off
+    (000, 000, 255),         # Blue
+    (255, 000, 000),         # Red
+    (000, 255, 000),         # Green
+    (255, 158, 108),         # On Natural
+    (255, 255, 255),         # On Full
+)
+
+def button_edge(var_gpio):
+    var_button_edges.put((var_gpio, time()))
+    if var_gpio in var_button_owner:
+        poll_boost(True, var_button_owner[var_gpio])
+
+# Button Actions
+# Called with the pressed GPIO (a tuple for chords) and var_step, which counts
+# long-press repeats from 1 and is 0 for short presses and chords
 
+# Printer Power
+def action_power(var_gpio, var_step):
+    var_printer = printer_ctx()
+    output_value = GPIO.input(var_printer['gpio_rly1'])
+    if output_value == True:
+        #beep()                # Handled by monitor
+        GPIO.output(var_printer['gpio_rly1'], GPIO.LOW)
+        state_save()
+        if not var_printer['ready'].is_set():
+            log('Button', "Relay 1 ON, Connecting once OctoPrint is ready", pin=var_gpio, action='power_on')
+            var_printer['ready_connect'].append(var_gpio)
+            return
+        log('Button', "Relay 1 ON, Connecting to Printer", pin=var_gpio, action='power_on')
+        action_connect(var_gpio, var_step)
+    else:
+        log('Button', "Disconnecting from Printer, Relay 1 OFF, Relay 2 OFF", pin=var_gpio, action='power_off')
+        #beep()                # Handled by monitor
+        if var_printer['ready'].is_set():
+            printer_push('disconnect')
+        sleep(0.75)
+        GPIO.output(var_printer['gpio_rly1'], GPIO.HIGH)
+        GPIO.output(var_printer['gpio_rly2'], GPIO.HIGH)
+        state_save()
+        #beep('down')          # Handled by monitor
+
+# Connect to the powered-on printer and, once it is operational, home it
+# (heating up meanwhile with connect_preheat)
+def action_connect(var_gpio, var_step):
+    var_printer = printer_ctx()
+    if printer_push('connect')['ok']:
+        printer_push('home', var_printer['warmup_target'] if var_printer['connect_preheat'] == 1 else 'none')
+    else:
+        log('Button', "Error: Failed to connect to printer", pin=var_gpio, action='connect_failed')
+        beep('error')
+
+# Fan Power
+def action_fan(var_gpio, var_step):
+    var_printer = printer_ctx()
+    output_value = GPIO.input(var_printer['gpio_rly2'])
+    if output_value == True:
+        log('Button', "Relay 2 ON", pin=var_gpio, action='fan_on')
+        GPIO.output(var_printer['gpio_rly2'], GPIO.LOW)
+        state_save()
+        beep('up')
+    else:
+        log('Button', "Relay 2 OFF", pin=var_gpio, action='fan_off')
+        GPIO.output(var_printer['gpio_rly2'], GPIO.HIGH)
+        state_save()
+        beep('down')
+
+# Home / Cancel / Reconnect
+def action_home(var_gpio, var_step):
+    var_printer = printer_ctx()
+    output_value = GPIO.input(var_printer['gpio_rly1'])
+    if output_value == False:
+        var_state = printer_pull('state', 'detailed')
+        if var_state == 'Operational':
+            log('Button', "Home Printhead", pin=var_gpio, action='home')
+            beep('up')
+            printer_push('home')
+        elif (var_state == 'Printing') or (var_state == 'Paused'):
+            log('Button', "Cancel Print, Home Printhead", pin=var_gpio, action='abort')
+            printer_push('abort')
+            #beep('up')            # Handled by monitor
+        else:
+            log('Button', "Connecting to Printer, Home Printhead", pin=var_gpio, action='connect')
+            action_connect(var_gpio, var_step)
+    else:
+        log('Button', "Error: Printer is currently powered-off", pin=var_gpio, action='powered_off')
+        beep('error')
+
+# Printer Calibration Routine, falls back to Home / Cancel / Reconnect unless idle
+def action_calibrate(var_gpio, var_step):
+    var_printer = printer_ctx()
+    if (GPIO.input(var_printer['gpio_rly1']) == False) and (printer_pull('state', 'detailed') == 'Operational'):
+        log('Button', "Calibrating Printer", pin=var_gpio, action='calibrate')
+        beep('up')
+        printer_push('calibrate')
+    else:
+        action_home(var_gpio, var_step)
+
+# Cancel Print
+def action_abort(var_gpio, var_step):
+    if printer_pull('state', 'detailed') in ('Printing', 'Paused'):
+        log('Button', "Cancel Print, Home Printhead", pin=var_gpio, action='abort')
+        printer_push('abort')
+    else:
+        log('Button', "Error: Not printing", pin=var_gpio, action='not_printing')
+        beep('error')
+
+# Heat / Cool
+def action_heat(var_gpio, var_step):
+    var_printer = printer_ctx()
+    var_state = printer_pull('state')
+    if var_state != 'Connected':
+        log('Button', "Error: Connection test failed", pin=var_gpio, action='not_connected')
+        beep('error')
+        return
+    var_tool0 = telemetry_fresh('tool0')
+    if var_tool0 is not None:
+        if var_tool0['target'] == 0:
+            log('Button', "Warming Up ({}c), at {:.0f}c".format(var_printer['warmup_target'], var_tool0['actual']), pin=var_gpio, action='heat', target=var_printer['warmup_target'])
+            beep('up')
+            printer_push('temp', var_printer['warmup_target'])
+        else:
+            log('Button', "Cooling Down (0c), at {:.0f}c".format(var_tool0['actual']), pin=var_gpio, action='cool')
+            beep('down')
+            printer_push('temp', 0.0)
+    else:
+        log('Button', "Error: Unable to get current temp target", pin=var_gpio, action='target_failed')
+        beep('error')
+
+# LED Lighting Selection, one color per hold step
+def action_rgb(var_gpio, var_step):
+    if (var_step < 1) or (var_step > len(var_rgb_colors)):
+        return
+    var_state = printer_pull('state')
+    if var_state != 'Connected':
+        if var_step == 1:
+            log('Button', "Error: Connection test failed", pin=var_gpio, action='not_connected')
+            beep('error')
+        return
+    if var_step == 1:
+        log('Button', "RGB Color Selection", pin=var_gpio, action='rgb')
+    var_red, var_green, var_blue = var_rgb_colors[var_step - 1]
+    printer_push('rgb', var_red, var_green, var_blue)
+
+# Extrude (Temp Check)
+def action_extrude(var_gpio, var_step):
+    var_state = printer_pull('state')
+    if var_state != 'Connected':
+        log('Button', "Error: Connection test failed", pin=var_gpio, action='not_connected')
+        beep('error')
+        return
+    var_tool0 = telemetry_fresh('tool0')
+    if var_tool0 is not None:
+        if var_tool0['actual'] >= var_conf_extrude_temp:
+            log('Button', "Extruding (2mm)", pin=var_gpio, action='extrude')
+            beep('up')
+            printer_push('extrude', 2)
+        elif (var_tool0['target'] >= var_conf_extrude_temp) and (var_tool0['eta'] is not None):
+            log('Button', "Error: Hotend heating ({:.0f}c), ready in {:.0f}s".format(var_tool0['actual'], var_tool0['eta']), pin=var_gpio, action='heating', eta=round(var_tool0['eta'], 1))
+            beep('error')
+        else:
+            log('Button', "Error: Hotend too cold to extrude ({:.0f}c)".format(var_tool0['actual']), pin=var_gpio, action='too_cold')
+            beep('error')
+    else:
+        log('Button', "Error: Unable to get current temp target", pin=var_gpio, action='target_failed')
+
+# Cold Extrude (Forced)
+def action_extrude_forced(var_gpio, var_step):
+    var_state = printer_pull('state')
+    if var_state != 'Connected':
+        if var_step <= 1:
+            log('Button', "Error: Connection test failed", pin=var_gpio, action='not_connected')
+            beep('error')
+        return
+    log('Button', "Extruding (2mm) - Forced", pin=var_gpio, action='extrude_forced')
+    beep('up')
+    printer_push('extrude', 2)
+
+# Pause / Resume
+def action_pause(var_gpio, var_step):
+    var_jobstatus = printer_pull('job')
+    if var_jobstatus == 'Printing':
+        log('Button', "Pause Print", pin=var_gpio, action='pause')
+        #beep('down')              # Handled by monitor
+        printer_push('pause')
+    elif var_jobstatus == 'Paused':
+        log('Button', "Resume Print", pin=var_gpio, action='resume')
+        #beep('up')                # Handled by monitor
+        printer_push('resume')
+    else:
+        log('Button', "Error", pin=var_gpio, action='no_job')
+        beep('error')
+
+# Panel Layout
+# Maps printers, buttons and gestures to the actions above. Read at startup
+# from var_conf_panel (YAML, or JSON when the name ends in .json), see
+# etc/controlpad.yaml; the built-in layout below is used when the file is
+# missing. panel_compile() turns it into var_button_dispatch, so dispatch is a
+# single lookup per gesture. A layout is one printer, or a list of them under
+# printers:, each with:
+#   name, api_host, api_port, api_config or api_key, warmup_target,
+#   connect_preheat, shutdown_auto, shutdown_time, shutdown_temp,
+#   runout_pause: printer settings, defaults from User Vars
+#   pins:     output/sensor GPIO overrides (rly1, rly2, led0-2, sen0, and the
+#             shared spk1 and btn5, the Pi power button)
+#   buttons:  GPIO -> short / long, each an action name or {action, repeat}
+#             (long only: repeat the action every <repeat> seconds while held)
+#   chords:   list of {buttons: [GPIO, ...], action}, fired when all are held
+var_panel_actions = {
+    'power': action_power,
+    'fan': action_fan,
+    'home': action_home,
+    'calibrate': action_calibrate,
+    'abort': action_abort,
+    'heat': action_heat,
+    'rgb': action_rgb,
+    'extrude': action_extrude,
+    'extrude_forced': action_extrude_forced,
+    'pause': action_pause,
+}
+var_panel_offline = (action_power, action_fan) # Actions that don't need OctoPrint
+var_panel_pins = ('rly1', 'rly2', 'spk1', 'led0', 'led1', 'led2', 'sen0', 'btn5')
+var_panel_shared = ('spk1', 'btn5') # Pins of the Pi rather than of one printer
+var_panel_settings = {       # Printer setting -> type
+    'name': str,
+    'api_host': str,
+    'api_port': int,
+    'api_config': str,
+    'api_key': str,
+    'warmup_target': int,
+    'connect_preheat': int,
+    'shutdown_auto': int,
+    'shutdown_time': int,
+    'shutdown_temp': float,
+    'runout_pause': int,
+}
+var_panel_default = {
+    'buttons': {
+        var_gpio_btn0: {'short': 'power', 'long': 'fan'},
+        var_gpio_btn1: {'short': 'home', 'long': 'calibrate'},
+        var_gpio_btn2: {'short': 'heat', 'long': {'action': 'rgb', 'repeat': 0.55}},
+        var_gpio_btn3: {'short': 'extrude', 'long': {'action': 'extrude_forced', 'repeat': 0.75}},
+        var_gpio_btn4: {'short': 'pause'},
+    },
+}
+
+# Returns (action function, repeat interval) for one layout entry
+def panel_entry(var_entry):
+    if not isinstance(var_entry, dict):
+        var_entry = {'action': var_entry}
+    if var_entry.get('action') not in var_panel_actions:
+        raise ValueError("unknown action {}, use one of: {}".format(var_entry.get('action'), ', '.join(sorted(var_panel_actions))))
+    return var_panel_actions[var_entry['action']], float(var_entry.get('repeat', 0))
+
+# Moves the speaker or Pi power button, the pins all printers share
+def panel_shared(var_name, var_pin):
+    global var_gpio_spk1, var_gpio_btn5
+    if var_name == 'spk1':
+        var_gpio_spk1 = int(var_pin)
+    else:
+        var_gpio_btn5 = int(var_pin)
+
+# Applies one printer's settings and pins to var_printer, returns its dispatch
+# table, hold repeat intervals and chord index
+def panel_compile(var_panel, var_printer):
+    var_dispatch = {}
+    var_hold = {}
+    var_chords = {}
+    for var_key in var_panel:
+        if (var_key not in var_panel_settings) and (var_key not in ('pins', 'buttons', 'chords')):
+            raise ValueError("unknown setting {}".format(var_key))
+    for var_key, var_type in var_panel_settings.items():
+        if var_key in var_panel:
+            var_printer[var_key] = var_type(var_panel[var_key])
+    for var_name, var_pin in (var_panel.get('pins') or {}).items():
+        if var_name not in var_panel_pins:
+            raise ValueError("unknown pin {}, use one of: {}".format(var_name, ', '.join(var_panel_pins)))
+        if var_name in var_panel_shared:
+            panel_shared(var_name, var_pin)
+        else:
+            var_printer['gpio_' + var_name] = int(var_pin)
+    for var_gpio, var_gestures in (var_panel.get('buttons') or {}).items():
+        for var_gesture, var_entry in var_gestures.items():
+            if var_gesture not in ('short', 'long'):
+                raise ValueError("GPIO {}: unknown gesture {}, use short or long".format(var_gpio, var_gesture))
+            var_action, var_repeat = panel_entry(var_entry)
+            var_dispatch[(int(var_gpio), var_gesture)] = (var_printer, var_action)
+            if var_gesture == 'long':
+                var_hold[int(var_gpio)] = var_repeat
+    for var_chord in var_panel.get('chords') or []:
+        var_members = tuple(sorted(set(int(var_gpio) for var_gpio in var_chord['buttons'])))
+        if len(var_members) < 2:
+            raise ValueError("chord {} needs at least two buttons".format(list(var_members)))
+        var_dispatch[(var_members, 'chord')] = (var_printer, panel_entry(var_chord)[0])
+        for var_gpio in var_members:
+            var_chords.setdefault(var_gpio, []).append(var_members)
+    return var_dispatch, var_hold, var_chords
+
+def panel_read(var_path):
+    with open(var_path) as stream:
+        if var_path.endswith('.json'):
+            return json.load(stream)
+        import yaml              # Only imported for YAML layouts, a JSON layout starts faster
+        try:
+            return yaml.safe_load(stream)
+        except yaml.YAMLError as e:
+            raise ValueError(str(e))
+
+# Builds var_printers and the button tables, a GPIO or printer name may only
+# be used once
+def panel_load():
+    global var_buttons
+    var_panel = var_panel_default
+    try:
+        if os.path.exists(var_conf_panel):
+            var_panel = panel_read(var_conf_panel)
+        var_entries = [var_panel]
+        if 'printers' in var_panel:
+            var_entries = var_panel['printers']
+            for var_key in var_panel:
+                if var_key not in ('pins', 'printers'):
+                    raise ValueError("{} belongs to a printer when printers: is used".format(var_key))
+            for var_name, var_pin in (var_panel.get('pins') or {}).items():
+                if var_name not in var_panel_shared:
+                    raise ValueError("only {} are shared, {} belongs to a printer".format(' and '.join(var_panel_shared), var_name))
+                panel_shared(var_name, var_pin)
+        var_used = {}
+        for var_index, var_entry in enumerate(var_entries):
+            var_printer = printer_new('printer{}'.format(var_index + 1))
+            var_dispatch, var_hold, var_chords = panel_compile(var_entry, var_printer)
+            if var_printer['name'] in [var_other['name'] for var_other in var_printers]:
+                raise ValueError("printer name {} is used twice".format(var_printer['name']))
+            var_owned = [var_gpio for var_gpio, var_gesture in var_dispatch if var_gesture != 'chord'] + list(var_chords)
+            for var_gpio in set([var_printer['gpio_' + var_name] for var_name in var_panel_pins if var_name not in var_panel_shared] + var_owned):
+                if var_gpio in var_used:
+                    raise ValueError("{}: GPIO {} is already used by {}".format(var_printer['name'], var_gpio, var_used[var_gpio]))
+                var_used[var_gpio] = var_printer['name']
+            for var_gpio in set(var_owned):
+                var_button_owner[var_gpio] = var_printer
+            for var_chord_list in var_chords.values():
+                for var_chord in var_chord_list:
+                    var_button_owner[var_chord] = var_printer
+            for var_gpio, var_chord_list in var_chords.items():
+                var_button_chords.setdefault(var_gpio, []).extend(var_chord_list)
+            var_button_dispatch.update(var_dispatch)
+            var_button_hold.update(var_hold)
+            var_printers.append(var_printer)
+        var_shared = [('spk1', var_gpio_spk1)]
+        if var_conf_power_button == 1:
+            var_shared.append(('btn5', var_gpio_btn5))
+            var_button_dispatch[(var_gpio_btn5, 'short')] = (None, system_halt)
+        for var_name, var_gpio in var_shared:
+            if var_gpio in var_used:
+                raise ValueError("{}: GPIO {} is already used by {}".format(var_name, var_gpio, var_used[var_gpio]))
+            var_used[var_gpio] = var_name
+    except (IOError, ValueError, KeyError, TypeError, AttributeError) as e:
+        log('Panel', "Error: Invalid layout in {} ({})".format(var_conf_panel, e))
+        log_flush()
+        sys.exit(1)
+    var_buttons = tuple(sorted(set(var_gpio for var_gpio, var_gesture in var_button_dispatch if var_gesture != 'chord') | set(var_gpio for var_gpio in var_button_owner if not isinstance(var_gpio, tuple))))
+    log('Panel', "{} printer(s), {} buttons, {} actions".format(len(var_printers), len(var_buttons), len(var_button_dispatch)), source_file=var_conf_panel if var_panel is not var_panel_default else 'built-in')
+
+def button_action(var_action, var_gpio, var_step):
+    var_printer = printer_ctx()
+    if (not var_printer['ready'].is_set()) and (var_action not in var_panel_offline):
+        if var_step <= 1:
+            log('Button', "Error: OctoPrint is not ready yet", pin=var_gpio, action='not_ready')
+            beep('error')
+        return
+    var_action(var_gpio, var_step)
+
+# Button Action Worker
+# One per printer, so a slow action on one printer never holds up another's.
+# Runs the control socket's actions too, var_done is then the request waiting
+# for it (finished event and ok) and var_gpio is None.
+def button_worker(var_printer):
+    printer_bind(var_printer)
     while True:
-        # Button - Printer Power
-        input_value = GPIO.input(var_gpio_btn0)
-        if input_value == False:
-
-            # Button Long-Press - Fan Power
-            var_longpress = 0
-            while input_value == False:
-                if  var_longpress >= 15:
-                    output_value = GPIO.input(var_gpio_rly2)
-                    if output_value == True:
-                        print("Button, GPIO {}, Relay 2 ON").format(var_gpio_btn0)
-                        GPIO.output(var_gpio_rly2, GPIO.LOW)
-                        beep('up')
-                    else:
-                        print("Button, GPIO {}, Relay 2 OFF").format(var_gpio_btn0)
-                        GPIO.output(var_gpio_rly2, GPIO.HIGH)
-                        beep('down')
-                    sleep(0.5)
-                    while input_value == False:
-                        input_value = GPIO.input(var_gpio_btn0)
-                var_longpress = var_longpress + 1
-                input_value = GPIO.input(var_gpio_btn0)
-                sleep(0.05)
-
-            # Button Short-Press - Printer Power
-            if var_longpress < 15:
-                output_value = GPIO.input(var_gpio_rly1)
-                if output_value == True:
-                    print("Button, GPIO {}, Relay 1 ON, Connecting to Printer").format(var_gpio_btn0)
-                    #beep()                # Handled by monitor
-                    GPIO.output(var_gpio_rly1, GPIO.LOW)
-                    printer_push('connect')
-                    var_state = printer_pull('state')
-                    if var_state == 'Connected':
-                        printer_push('home')
-                    else:
-                        print("Button, GPIO {}, Error: Failed to connect to printer").format(var_gpio_btn0)
-                        beep('error')
-                else:
-                    print("Button, GPIO {}, Disconnecting from Printer, Relay 1 OFF, Relay 2 OFF").format(var_gpio_btn0)
-                    #beep()                # Handled by monitor
-                    printer_push('disconnect')
-                    sleep(0.75)
-                    GPIO.output(var_gpio_rly1, GPIO.HIGH)
-                    GPIO.output(var_gpio_rly2, GPIO.HIGH)
-                    #beep('down')          # Handled by monitor
-            var_longpress = 0
-            sleep(0.5)
-            while input_value == False:
-                input_value = GPIO.input(var_gpio_btn0)
+        watchdog_beat(None)
+        var_action, var_gesture, var_gpio, var_step, var_stamp, var_done = var_printer['actions'].get()
+        watchdog_beat()
+        if var_stop.is_set():
+            return
+        var_ok = True
+        if var_step <= 1:
+            stats_add('button' if var_done is None else 'socket', var_action.__name__.replace('action_', '', 1))
+        try:
+            button_action(var_action, var_gpio, var_step)
+        except Exception:
+            var_ok = False
+            log('Button', "Error: {} action failed".format(var_gesture), pin=var_gpio, action='crashed', trace=traceback.format_exc())
+        if var_done is not None:
+            var_done['ok'] = var_ok
+            var_done['finished'].set()
+        else:
+            var_label = '+'.join(str(var_member) for var_member in var_gpio) if isinstance(var_gpio, tuple) else str(var_gpio)  # Chords as '4+27'
+            metric_observe('controlpad_button_action_seconds', (('printer', var_printer['name']), ('gpio', var_label), ('gesture', var_gesture)), time() - var_stamp)
 
-        # Button - Home / Cancel / Reconnect
-        input_value = GPIO.input(var_gpio_btn1)
-        if input_value == False:
-            output_value = GPIO.input(var_gpio_rly1)
-            if output_value == False:
-                var_state = printer_pull('state', 'detailed')
-
-                # Button Long-Press - Calibrate Printer
-                var_longpress = 0
-                if var_state == 'Operational':
-                    while input_value == False:
-                        if  var_longpress >= 15:
-                            print("Button, GPIO {}, Calibrating Printer").format(var_gpio_btn1)
-                            beep('up')
-                            printer_push('calibrate')
-                            sleep(0.5)
-                            while input_value == False:
-                                input_value = GPIO.input(var_gpio_btn1)
-                        var_longpress = var_longpress + 1
-                        input_value = GPIO.input(var_gpio_btn1)
-                        sleep(0.05)
-
-                # Button Short-Press - Home / Cancel / Reconnect
-                if var_longpress < 15:
-                    #var_state = printer_pull('state', 'detailed')
-                    if var_state == 'Operational':
-                        print("Button, GPIO {}, Home Printhead").format(var_gpio_btn1)
-                        beep('up')
-                        printer_push('home')
-                    elif (var_state == 'Printing') or (var_state == 'Paused'):
-                        print("Button, GPIO {}, Cancel Print, Home Printhead").format(var_gpio_btn1)
-                        printer_push('cancel')
-                        #beep('up')            # Handled by monitor
-                        printer_push('temp', 0.0)
-                        printer_push('home')
-                    else:
-                        print("Button, GPIO {}, Connecting to Printer, Home Printhead").format(var_gpio_btn1)
-                        printer_push('connect')
-                        var_state = printer_pull('state')
-                        if var_state == 'Connected':
-                            print("Button, GPIO {}, Connection successful").format(var_gpio_btn1)
-                            #beep('up')        # Handled by monitor
-                            printer_push('home')
-                        else:
-                            print("Button, GPIO {}, Error: Failed to connect to printer").format(var_gpio_btn1)
-                            beep('error')
-                var_longpress = 0
-            else:
-                print("Button, GPIO {}, Error: Printer is currently powered-off").format(var_gpio_btn1)
-                beep('error')
-            sleep(0.5)
-            while input_value == False:
-                input_value = GPIO.input(var_gpio_btn1)
-
-        # Button - Heat / Cool
-        input_value = GPIO.input(var_gpio_btn2)
-        if input_value == False:
-            var_state = printer_pull('state')
-            if var_state == 'Connected':
-
-                # Button Long-Press - Printer RGB
-                var_longpress = 0
-                while input_value == False:
-                    if var_longpress == 15:
-                        print("Button, GPIO {}, RGB Color Selection").format(var_gpio_btn2)
-                        printer_push('rgb', 000, 000, 000) # Off
-                        sleep(0.5)
-                    elif var_longpress == 16:
-                        printer_push('rgb', 000, 000, 255) # Blue
-                        sleep(0.5)
-                    elif var_longpress == 17:
-                        printer_push('rgb', 255, 000, 000) # Red
-                        sleep(0.5)
-                    elif var_longpress == 18:
-                        printer_push('rgb', 000, 255, 000) # Green
-                        sleep(0.5)
-                    elif var_longpress == 19:
-                        printer_push('rgb', 255, 158, 108) # On Natural
-                        sleep(0.5)
-                    elif var_longpress >= 20:
-                        printer_push('rgb', 255, 255, 255) # On Full
-                        while input_value == False:
-                            input_value = GPIO.input(var_gpio_btn2)
-                    var_longpress = var_longpress + 1
-                    input_value = GPIO.input(var_gpio_btn2)
-                    sleep(0.05)
-
-                # Button Short-Press - Heat / Cool
-                if var_longpress < 15:
-                    var_target = printer_pull('target')
-                    if var_target != 'Error':
-                        if var_target == '0.0':
-                            print("Button, GPIO {}, Warming Up (200c)").format(var_gpio_btn2)
-                            beep('up')
-                            printer_push('temp', var_conf_warmup_target)
-                        else:
-                            print("Button, GPIO {}, Cooling Down (0c)").format(var_gpio_btn2)
-                            beep('down')
-                            printer_push('temp', 0.0)
-                    else:
-                        print("Button, GPIO {}, Error: Unable to get current temp target").format(var_gpio_btn2)
-                        beep('error')
-                var_longpress = 0
-            else:
-               print("Button, GPIO {}, Error: Connection test failed").format(var_gpio_btn2)
-               beep('error')
-            sleep(0.5)
-            while input_value == False:
-                input_value = GPIO.input(var_gpio_btn2)
-
-        # Button - Extrude
-        input_value = GPIO.input(var_gpio_btn3)
-        if input_value == False:
-            var_state = printer_pull('state')
-            if var_state == 'Connected':
-
-                # Button Long-Press - Cold Extrude (Forced)
-                var_longpress = 0
-                while input_value == False:
-                    if  var_longpress >= 15:
-                        while input_value == False:
-                            input_value = GPIO.input(var_gpio_btn3)
-                            print("Button, GPIO {}, Extruding (2mm) - Forced").format(var_gpio_btn3)
-                            beep('up')
-                            printer_push('extrude', 2)
-                            sleep(0.7)
-
-                    var_longpress = var_longpress + 1
-                    input_value = GPIO.input(var_gpio_btn3)
-                    sleep(0.05)
-
-                # Button Short-Press - Extrude (Temp Check)
-                if var_longpress < 15:
-                    var_target = printer_pull('target')
-                    if var_target != 'Error':
-                        var_target_float = float(var_target)
-                        if var_target_float >= 180.0:
-                            print("Button, GPIO {}, Extruding (2mm)").format(var_gpio_btn3)
-                            beep('up')
-                            printer_push('extrude', 2)
-                        else:
-                            print("Button, GPIO {}, Error: Hotend too cold to extrude").format(var_gpio_btn3)
-                            beep('error')
-                    else:
-                        print("Button, GPIO {}, Error: Unable to get current temp target").format(var_gpio_btn3)
-                var_longpress = 0
+# Hand a gesture to the button worker of the printer owning the button or chord,
+# var_decided is the edge or hold deadline that decided it. Actions of the Pi
+# itself (no printer) get a thread of their own.
+def button_dispatch(var_gesture, var_gpio, var_step, var_stamp, var_decided):
+    var_printer, var_action = var_button_dispatch.get((var_gpio, var_gesture), (None, None))
+    if (var_action is not None) and (var_printer is None):
+        thread_start(var_action, var_gpio, var_step)
+    elif var_action is not None:
+        var_printer['actions'].put((var_action, var_gesture, var_gpio, var_step, var_stamp, None))
+    metric_observe('controlpad_button_classify_seconds', (('gesture', var_gesture),), time() - var_decided)
+
+# Time at which a held button fires its next long-press step
+def button_hold_deadline(var_pressed, var_gpio, var_step):
+    if var_step == 0:
+        return var_pressed + var_conf_longpress
+    if var_button_hold[var_gpio] == 0:
+        return float('inf')
+    return var_pressed + var_conf_longpress + (var_step * var_button_hold[var_gpio])
+
+# The chord completed by pressing var_gpio, if any
+def button_chord(var_pressed, var_gpio):
+    for var_chord in var_button_chords.get(var_gpio, ()):
+        if all((var_member in var_pressed) for var_member in var_chord):
+            return var_chord
+    return None
+
+# Control Socket
+# Other local tools talk to the daemon over a Unix socket instead of polling
+# OctoPrint themselves. Requests and replies are JSON lines:
+#   {"cmd": "state"}                        snapshot of every printer, from memory
+#   {"cmd": "subscribe"}                    a snapshot now and one line per change
+#   {"cmd": "action", "action": "home", "printer": "printer1", "step": 0}
+#                                           run a button action (or connect) on the
+#                                           printer's button worker, replies once done
+# Replies carry ok, and error when ok is false. printer may be left out with one
+# printer. Snapshots come from the monitor's shared state, the temperature
+# telemetry and the GPIOs, so no consumer ever adds OctoPrint requests.
+var_control_changed = threading.Condition()
+var_control_version = [0]    # Bumped on every change a subscriber may want to see
+
+def control_notify():
+    with var_control_changed:
+        var_control_version[0] = var_control_version[0] + 1
+        var_control_changed.notify_all()
+
+def control_snapshot(var_printer):
+    printer_bind(var_printer)
+    with var_printer['cache_lock']:
+        var_state = var_printer['cache'].get('state', 'Error')
+    var_powered = (GPIO.input(var_printer['gpio_rly1']) == GPIO.LOW)
+    var_heaters = {}
+    with var_printer['telemetry_lock']:
+        var_names = list(var_printer['telemetry'])
+    for var_heater in var_names:
+        var_reading = telemetry_read(var_heater)
+        if var_reading is not None:
+            var_heaters[var_heater] = {'actual': round(var_reading['actual'], 1), 'target': round(var_reading['target'], 1), 'eta': None if var_reading['eta'] is None else round(var_reading['eta'])}
+    return {
+        'printer': var_printer['name'],
+        'ready': var_printer['ready'].is_set(),
+        'power': var_powered,
+        'fan': (GPIO.input(var_printer['gpio_rly2']) == GPIO.LOW),
+        'state': printer_state(var_state, 'detailed') if var_powered else 'Disconnected',
+        'heaters': var_heaters,
+        'runout': var_printer['runout'],
+        'shutdown': var_printer['shutdown'],
+        'poll': {'interval': round(var_printer['poll']['interval'], 3), 'reason': var_printer['poll']['reason']},
+    }
+
+def control_action(var_request):
+    var_printer = None
+    for var_candidate in var_printers:
+        if (var_candidate['name'] == var_request.get('printer')) or (('printer' not in var_request) and (len(var_printers) == 1)):
+            var_printer = var_candidate
+    if var_printer is None:
+        return {'ok': False, 'error': 'unknown printer {}'.format(var_request.get('printer'))}
+    var_name = var_request.get('action')
+    var_action = var_panel_actions.get(var_name)
+    if var_name == 'connect':
+        var_action = action_connect
+    if var_action is None:
+        return {'ok': False, 'error': 'unknown action {}'.format(var_name)}
+    if (not var_printer['ready'].is_set()) and (var_action not in var_panel_offline):
+        return {'ok': False, 'error': 'OctoPrint is not ready yet'}
+    if shutdown_abort(var_printer, 'control socket {}'.format(var_name)):   # Like a button press, it only aborts
+        return {'ok': True, 'aborted': 'shutdown', 'printers': [control_snapshot(var_printer)]}
+    var_done = {'finished': threading.Event(), 'ok': False}
+    var_printer['actions'].put((var_action, var_name, None, int(var_request.get('step', 0)), time(), var_done))
+    if not var_done['finished'].wait(var_conf_socket_timeout):
+        return {'ok': False, 'error': 'action still running'}
+    if not var_done['ok']:
+        return {'ok': False, 'error': 'action failed'}
+    return {'ok': True, 'printers': [control_snapshot(var_printer)]}
+
+class ControlHandler(StreamRequestHandler):
+    def reply(self, var_reply):
+        self.wfile.write((json.dumps(var_reply, sort_keys=True) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            self.serve()
+        except socket.error:
+            pass                                     # Client went away
+
+    def finish(self):
+        try:
+            StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def serve(self):
+        for var_line in iter(self.rfile.readline, b''):
+            try:
+                var_request = json.loads(var_line.decode('utf-8'))
+                var_cmd = var_request['cmd']
+            except (ValueError, KeyError, TypeError):
+                self.reply({'ok': False, 'error': 'expected a JSON object with cmd'})
+                continue
+            metric_inc('controlpad_control_requests_total', (('cmd', str(var_cmd)),))
+            if var_cmd == 'state':
+                self.reply({'ok': True, 'printers': [control_snapshot(var_printer) for var_printer in var_printers]})
+            elif var_cmd == 'subscribe':
+                self.subscribe()
+                return
+            elif var_cmd == 'action':
+                try:
+                    self.reply(control_action(var_request))
+                except (ValueError, TypeError) as e:
+                    self.reply({'ok': False, 'error': str(e)})
             else:
-                print("Button, GPIO {}, Error: Connection test failed").format(var_gpio_btn3)
-                beep('error')
-            sleep(0.5)
-            while input_value == False:
-                input_value = GPIO.input(var_gpio_btn3)
-
-        # Button - Play / Pause
-        input_value = GPIO.input(var_gpio_btn4)
-        if input_value == False:
-            var_jobstatus = printer_pull('job')
-            if var_jobstatus == 'Printing':
-                print("Button, GPIO {}, Pause Print").format(var_gpio_btn4)
-                #beep('down')              # Handled by monitor
-                printer_push('pause')
-            elif var_jobstatus == 'Paused':
-                print("Button, GPIO {}, Resume Print").format(var_gpio_btn4)
-                #beep('up')                # Handled by monitor
-                printer_push('resume')
+                self.reply({'ok': False, 'error': 'unknown cmd {}'.format(var_cmd)})
+
+    def subscribe(self):
+        var_seen = None
+        var_sent = None
+        while not var_stop.is_set():
+            with var_control_changed:
+                if var_control_version[0] == var_seen:
+                    var_control_changed.wait(var_conf_socket_timeout)
+                var_seen = var_control_version[0]
+            var_snapshot = [control_snapshot(var_printer) for var_printer in var_printers]
+            if var_snapshot != var_sent:
+                self.reply({'ok': True, 'printers': var_snapshot})
+                var_sent = var_snapshot
+
+def control_serve():
+    if os.path.exists(var_conf_socket):
+        os.remove(var_conf_socket)                   # Left over from an earlier run
+    try:
+        server = ThreadingUnixStreamServer(var_conf_socket, ControlHandler)
+        os.chmod(var_conf_socket, var_conf_socket_mode)
+    except (socket.error, OSError) as e:
+        log('Control', "Error: Can't listen on {} ({})".format(var_conf_socket, e))
+        return
+    server.daemon_threads = True
+    log('Control', "Listening on {}".format(var_conf_socket))
+    server.serve_forever()
+
+# Input Task (main thread)
+# Debounce: a pin counts as changed once it has held its new level for
+# var_conf_debounce after the first edge; the gesture is timed from that edge.
+# Long-press and chord buttons report 'short' on release, or 'long' once held
+# past var_conf_longpress (then every var_button_hold seconds while held).
+# Other buttons report 'short' as soon as they are pressed. Pressing the last
+# button of a chord reports 'chord', and its buttons report nothing else until
+# released.
+def loop():
+    var_pressed = {}         # GPIO -> press timestamp
+    var_steps = {}           # GPIO -> long-press steps fired during the current press, -1 once used by a chord
+    var_settle = {}          # GPIO -> (settle deadline, first edge timestamp)
+
+    for var_gpio in var_buttons:
+        GPIO.add_event_detect(var_gpio, GPIO.BOTH, callback=button_edge)
+    for var_printer in var_printers:
+        thread_start(task, 'buttons ' + var_printer['name'], button_worker, var_printer)
+    startup_report('inputs', "Ready! Listening for inputs and state changes")
+    sd_notify('READY=1')
+    var_watchdog_local.name = 'input'
+
+    while not var_stop.is_set():
+        watchdog_beat(1.0)
+        # Sleep until the next edge, settle deadline or long-press deadline
+        var_deadlines = [var_deadline for var_deadline, var_stamp in var_settle.values()]
+        for var_gpio in var_pressed:
+            if (var_gpio in var_button_hold) and (var_steps[var_gpio] >= 0):
+                var_deadlines.append(button_hold_deadline(var_pressed[var_gpio], var_gpio, var_steps[var_gpio]))
+        var_timeout = 1.0
+        if var_deadlines:
+            var_timeout = min(max(min(var_deadlines) - time(), 0), var_timeout)
+        try:
+            var_gpio, var_stamp = var_button_edges.get(timeout=var_timeout)
+            if var_gpio not in var_settle:
+                var_settle[var_gpio] = (var_stamp + var_conf_debounce, var_stamp)
+        except Empty:
+            pass
+
+        var_now = time()
+        for var_gpio, (var_deadline, var_stamp) in list(var_settle.items()):
+            if var_now < var_deadline:
+                continue
+            del var_settle[var_gpio]
+            input_value = GPIO.input(var_gpio)
+            if (input_value == False) and (var_gpio not in var_pressed):
+                var_pressed[var_gpio] = var_stamp
+                var_steps[var_gpio] = 0
+                var_chord = button_chord(var_pressed, var_gpio)
+                if (var_gpio in var_button_owner) and shutdown_abort(var_button_owner[var_gpio], 'button', var_gpio):
+                    var_steps[var_gpio] = -1                 # The press only aborts
+                elif var_chord is not None:
+                    for var_member in var_chord:
+                        var_steps[var_member] = -1
+                    button_dispatch('chord', var_chord, 0, var_stamp, var_stamp)
+                elif (var_gpio not in var_button_hold) and (var_gpio not in var_button_chords):
+                    button_dispatch('short', var_gpio, 0, var_stamp, var_stamp)
+            elif (input_value == True) and (var_gpio in var_pressed):
+                if ((var_gpio in var_button_hold) or (var_gpio in var_button_chords)) and (var_steps[var_gpio] == 0):
+                    button_dispatch('short', var_gpio, 0, var_stamp, var_stamp)
+                del var_pressed[var_gpio]
+
+        for var_gpio in var_pressed:
+            if (var_gpio not in var_button_hold) or (var_steps[var_gpio] < 0):
+                continue
+            var_deadline = button_hold_deadline(var_pressed[var_gpio], var_gpio, var_steps[var_gpio])
+            if var_now >= var_deadline:
+                var_steps[var_gpio] = var_steps[var_gpio] + 1
+                button_dispatch('long', var_gpio, var_steps[var_gpio], var_now, var_deadline)
+
+# Pi Power Button
+# Button 5 halts the Pi, staged: the shutdown sound plays while the heaters of
+# every connected printer go off, the relays (and so the printers' hotend fans)
+# stay on until those hotends are below shutdown_temp or var_conf_halt_cooldown
+# has passed, like the cooling phase of the automatic shutdown, then the daemon
+# stops as on any exit (destroy() disconnects the printers and switches the
+# relays off) and finally halts. Pressing Button 5 again skips the cooling.
+var_halt = threading.Event()
+var_halt_now = threading.Event()
+
+def system_halt(var_gpio, var_step):
+    if var_halt.is_set():
+        if not var_halt_now.is_set():
+            var_halt_now.set()
+            log('System', "Pi power button pressed again, not waiting for the hotends to cool", pin=var_gpio, action='halt_now')
+        return
+    var_halt.set()
+    log('System', "Pi power button pressed, shutting down", pin=var_gpio, action='halt')
+    beep('shutdown')
+    var_cooling = []
+    for var_printer in var_printers:
+        printer_bind(var_printer)
+        if var_printer['ready'].is_set() and (GPIO.input(var_printer['gpio_rly1']) == False) and (printer_pull('state') == 'Connected'):
+            log('System', "Cooling Down (0c)", action='cool')
+            printer_push('temp', 0.0)
+            var_cooling.append(var_printer)
+    system_cooldown(var_cooling)
+    var_sound_idle.wait(2.0)
+    var_stop.set()                                   # loop() returns, then destroy()
+
+# Wait until the hotends of var_cooling are cool, with LED 1 blinking on the
+# printers still cooling
+def system_cooldown(var_cooling):
+    var_start = time()
+    var_first = True
+    while var_cooling and (var_conf_halt_cooldown > 0) and (not var_stop.is_set()):
+        var_waits = []
+        for var_printer in list(var_cooling):
+            printer_bind(var_printer)
+            var_wait = shutdown_cooling(var_printer)
+            if var_wait is None:
+                var_cooling.remove(var_printer)
+                led_set(var_printer['gpio_led1'], 'on')
             else:
-                print("Button, GPIO {}, Error").format(var_gpio_btn4)
-                beep('error')
-            sleep(0.5)
-            while input_value == False:
-                input_value = GPIO.input(var_gpio_btn4)
+                var_waits.append(var_wait)
+                if var_first:
+                    log('System', "Waiting for the hotend to cool below {:.0f}C".format(var_printer['shutdown_temp']), action='halt_cooling')
+                    led_set(var_printer['gpio_led1'], 'blink', 0.5)
+        var_first = False
+        if not var_cooling:
+            log('System', "Hotends cooled after {:.0f}s".format(time() - var_start), action='halt_cooled', latency=round(time() - var_start, 1))
+            return
+        var_remaining = var_conf_halt_cooldown - (time() - var_start)
+        if var_remaining <= 0:
+            for var_printer in var_cooling:
+                log('System', "Error: Hotend still above {:.0f}C after {}s, halting anyway".format(var_printer['shutdown_temp'], var_conf_halt_cooldown), action='halt_timeout', printer=var_printer['name'])
+            return
+        if var_halt_now.wait(min(min(var_waits), var_remaining)):
+            return
 
-        sleep(0.05) # Reduce CPU usage of while loop
+def system_poweroff():
+    log('System', "Halting the Pi", action='poweroff')
+    log_flush()
+    if var_conf_gpio_backend == 'sim':
+        return                                       # Never halt the box running the simulator
+    subprocess.call(['shutdown', '-h', 'now'], shell=False)
 
 # Cleanup on Exit
 def destroy():
-    printer_push('disconnect')
-    GPIO.output(var_gpio_led2, GPIO.LOW)   # led 2 off
+    sd_notify('STOPPING=1')
+    var_stop.set()
+    var_led_wake.set()
+    for var_printer in var_printers:
+        var_printer['wake'].set()
+        var_printer['runout_edge'].set()
+    for var_printer in var_printers:
+        if var_printer['monitor'] is not None:
+            var_printer['monitor'].join(2.0)                # Let the monitor finish its pass
+    for var_printer in var_printers:
+        printer_bind(var_printer)
+        if var_printer['ready'].is_set():
+            printer_push('disconnect')
+        led_set(var_printer['gpio_led2'], 'off')            # led 2 off
     sleep(0.75)
-    GPIO.output(var_gpio_led1, GPIO.LOW)   # led 1 off
-    GPIO.output(var_gpio_rly1, GPIO.HIGH)  # Relay 1 off (printer)
-    GPIO.output(var_gpio_rly2, GPIO.HIGH)  # Relay 2 off (fan)
-    GPIO.output(var_gpio_led0, GPIO.LOW)   # led 0 off
-    p1.terminate()
+    for var_printer in var_printers:
+        led_set(var_printer['gpio_led1'], 'off')            # led 1 off
+        GPIO.output(var_printer['gpio_rly1'], GPIO.HIGH)    # Relay 1 off (printer)
+        GPIO.output(var_printer['gpio_rly2'], GPIO.HIGH)    # Relay 2 off (fan)
+        led_set(var_printer['gpio_led0'], 'off')            # led 0 off
+    var_sound_idle.wait(1.0)
     GPIO.cleanup()
+    if var_conf_socket and os.path.exists(var_conf_socket):
+        os.remove(var_conf_socket)
+    stats_flush()
+    log_flush()
 
 # Begin Execution
-conwait()
-print("Ready! Listening for inputs and state changes...")
+thread_start(task, 'log', log_worker)
+metric_set('controlpad_start_time_seconds', (), time())
+if var_conf_metrics_port != 0:
+    thread_start(task, 'metrics', metrics_serve)
+panel_load()
+for var_printer in var_printers:
+    api_key_load(var_printer)
+state_load()
+gpio_setup()
+thread_start(task, 'leds', led_worker)
+thread_start(task, 'sound', sound_worker)
+beep('startup')
+if var_conf_service == 1:
+    signal.signal(signal.SIGTERM, lambda var_signum, var_frame: service_exit(0))
+thread_start(task, 'watchdog', watchdog_loop)
+if var_conf_stats_file:
+    thread_start(task, 'stats', stats_worker)
 try:
-    p1 = Process(target=loop_monitor)
-    p1.start()
+    for var_printer in var_printers:
+        var_printer['monitor'] = thread_start(task, 'monitor ' + var_printer['name'], loop_monitor, var_printer)  # Waits for OctoPrint first
+        var_filament_owner[var_printer['gpio_sen0']] = var_printer
+        GPIO.add_event_detect(var_printer['gpio_sen0'], GPIO.BOTH, callback=filament_edge)
+        thread_start(task, 'filament ' + var_printer['name'], filament_loop, var_printer)
+    if var_conf_socket:
+        thread_start(task, 'control', control_serve)
+    if var_conf_gpio_backend == 'sim':
+        thread_start(GPIO.console)
     loop()
 except KeyboardInterrupt:
-    beep('down')
+    beep('down', True)
     destroy()
     sys.exit(1)
 except Exception:
+    log('Task', "Error: main crashed", task='main', trace=traceback.format_exc())
+    if var_conf_service == 1:
+        service_exit(1)                              # Restarted by systemd, resuming from the persisted state
     destroy()
     sys.exit(1)
 else:
     destroy()
+    if var_halt.is_set():
+        system_poweroff()
     sys.exit(0)